@@ -1,47 +1,478 @@
-from datetime import datetime, timedelta
+import time
+_module_load_started = time.perf_counter()
+
+from datetime import date, datetime, timedelta, timezone
 import json
-import requests
-import pandas as pd
-import boto3
+import csv
+import io
 import re
 import os
+import sys
+import math
+import gzip
+import zlib
+import base64
+import hashlib
+import uuid
+import importlib
+import functools
+import contextlib
+import contextvars
+import threading
 import logging
+import itertools
+import queue
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Third-party packages (requests, boto3, pandas) are imported through lazy_import on first use, so each
+# endpoint only pays for what it needs on a cold start. Set IMPORT_TIME_REPORT=true to log how long
+# each of those imports (and this module itself) took.
+IMPORT_TIME_REPORT = os.environ.get('IMPORT_TIME_REPORT', 'false').lower() == 'true'
+import_times = {}  # module name -> import time in milliseconds
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 log_file = '/tmp/execution_log.log'  # Temporary file in the Lambda environment
-file_handler = logging.FileHandler(log_file)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+file_handler = None  # Attached on the first invocation rather than at import
+
+# Each invocation's log lines are shipped as their own S3 object under logs/segments/YYYY/MM/DD/HH/.
+# 'background' uploads after the response is returned; 'sync' uploads before returning.
+LOG_PREFIX = 'logs/'
+LOG_SHIPPING = os.environ.get('LOG_SHIPPING', 'background')
+LOG_SEGMENT_DIR = '/tmp/log_segments'  # Segments waiting to be uploaded survive until a later invocation ships them
+_log_shipper = None
+
+INAT_OBSERVATIONS_URL = "https://api.inaturalist.org/v1/observations"
+
+# Upstream fetch configuration ('sequential', 'concurrent', 'keyset', 'sharded' or 'async')
+FETCH_MODE = os.environ.get('FETCH_MODE', 'concurrent')
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', 8))
+# Async mode: fetched pages allowed to wait for the serializer before fetching pauses
+ASYNC_QUEUE_PAGES = int(os.environ.get('ASYNC_QUEUE_PAGES', FETCH_WORKERS))
+# Sharded mode keeps splitting the date range until each window holds at most this many results
+SHARD_TARGET_RESULTS = int(os.environ.get('SHARD_TARGET_RESULTS', 1000))
+SHARD_QUEUE_PAGES = 2  # Pages each running shard may fetch ahead of the one being read
+# iNaturalist refuses page-based requests past this many results (page * per_page)
+MAX_PAGED_RESULTS = 10000
+
+# Fields observation_row reads from each observation (plus quality_grade and iconic_taxon_name for
+# incremental syncs); everything else is dropped while decoding
+OBSERVATION_FIELDS = ('id', 'observed_on', 'location', 'created_at', 'quality_grade')
+TAXON_FIELDS = ('name', 'preferred_common_name', 'native', 'iconic_taxon_name')
+
+# Day-partitioned observation cache in /tmp. Stored days are brought up to date with an incremental
+# updated_since query: days more than OBSERVATION_CACHE_STABLE_DAYS old every OBSERVATION_CACHE_SYNC_INTERVAL
+# seconds, more recent days every OBSERVATION_CACHE_RECENT_TTL seconds, and today on every request.
+OBSERVATION_CACHE_ENABLED = os.environ.get('OBSERVATION_CACHE', 'true').lower() == 'true'
+OBSERVATION_CACHE_DIR = os.environ.get('OBSERVATION_CACHE_DIR', '/tmp/observation_cache')
+OBSERVATION_CACHE_STABLE_DAYS = int(os.environ.get('OBSERVATION_CACHE_STABLE_DAYS', 7))
+OBSERVATION_CACHE_RECENT_TTL = int(os.environ.get('OBSERVATION_CACHE_RECENT_TTL', 900))
+OBSERVATION_CACHE_SYNC_INTERVAL = int(os.environ.get('OBSERVATION_CACHE_SYNC_INTERVAL', 86400))
+# Deleted observations never turn up in an updated_since query, so a day is fetched in full again
+# instead of synced once it has been synced this many times
+OBSERVATION_CACHE_REFETCH_SYNCS = int(os.environ.get('OBSERVATION_CACHE_REFETCH_SYNCS', 7))
+# Overlap each updated_since window by this many seconds to allow for clock skew with iNaturalist
+SYNC_OVERLAP_SECONDS = 300
+
+# Shared second cache tier in S3_BUCKET_NAME. Settled days are written once as gzipped partitions (and
+# again only when an incremental sync changes them), and
+# local copies are revalidated against S3 with If-None-Match every S3_CACHE_REVALIDATE_TTL seconds.
+S3_CACHE_ENABLED = os.environ.get('S3_CACHE', 'true').lower() == 'true'
+S3_CACHE_PREFIX = os.environ.get('S3_CACHE_PREFIX', 'cache/observations/')
+S3_CACHE_REVALIDATE_TTL = int(os.environ.get('S3_CACHE_REVALIDATE_TTL', 3600))
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # Point at a local S3 stand-in (e.g. MinIO) for testing
+
+# SQLite copy of the cached partitions as flattened rows, indexed for the /data taxon, user, native and
+# bbox filters. Loaded day by day from the partition cache, so it needs OBSERVATION_CACHE; without it
+# the filters are passed to iNaturalist instead.
+OBSERVATION_STORE_ENABLED = os.environ.get('OBSERVATION_STORE', 'true').lower() == 'true'
+OBSERVATION_STORE_PATH = os.environ.get('OBSERVATION_STORE_PATH', '/tmp/observations.sqlite3')
+# Days no request has read for OBSERVATION_STORE_RETENTION seconds are dropped from the store, so it
+# doesn't fill /tmp with every range ever asked for. A day's last use is recorded at most once per
+# STORE_TOUCH_INTERVAL seconds, so repeat requests don't each write to the store.
+OBSERVATION_STORE_RETENTION = int(os.environ.get('OBSERVATION_STORE_RETENTION', 7 * 86400))
+STORE_TOUCH_INTERVAL = 3600
+STORE_PAGE_ROWS = 1000  # Rows read from the store per page handed to the serializers
+STORE_SCHEMA_VERSION = 3  # A store file with any other PRAGMA user_version is rebuilt
+
+# Columns of the /data CSV, in order
+CSV_COLUMNS = (
+    "id", "observed_on", "latitude", "longitude", "user_login",
+    "created_at", "name", "preferred_common_name", "native", "photo_url",
+)
+
+# Response compression, negotiated from the request's Accept-Encoding header
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION', 'true').lower() == 'true'
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+# Below this much remaining invocation time, compress with the fastest level whatever the size
+COMPRESSION_FAST_MS = int(os.environ.get('COMPRESSION_FAST_MS', 10000))
+ESTIMATED_ROW_BYTES = 180  # Rough size of one CSV row, for choosing a compression level up front
+# Rough size of a row in each format relative to CSV, and of gzip/deflate output relative to its input.
+# Kept conservative: underestimating a body could push it past the payload limit.
+ESTIMATED_FORMAT_RATIOS = {"csv": 1.0, "ndjson": 2.1, "parquet": 0.35}
+ESTIMATED_COMPRESSION_RATIO = 0.35
+
+# Results estimated above OFFLOAD_THRESHOLD_BYTES are streamed to S3 with a multipart upload and the
+# response carries a presigned download link instead of the CSV (keeps clear of the 6 MB payload limit)
+OFFLOAD_ENABLED = os.environ.get('OFFLOAD', 'true').lower() == 'true'
+OFFLOAD_THRESHOLD_BYTES = int(os.environ.get('OFFLOAD_THRESHOLD_BYTES', 5 * 1024 * 1024))
+OFFLOAD_PREFIX = os.environ.get('OFFLOAD_PREFIX', 'exports/')
+OFFLOAD_URL_EXPIRY = int(os.environ.get('OFFLOAD_URL_EXPIRY', 3600))
+MULTIPART_PART_BYTES = 8 * 1024 * 1024  # S3 requires every part but the last to be at least 5 MB
+
+# Version of the metadata describing the /data columns
+DATA_METADATA_VERSION = "1.0.0"
+
+# Metadata documents are kept in memory across warm invocations and revalidated against S3 with their
+# ETag once METADATA_CACHE_TTL seconds old. metadata/latest.json names the newest version, so LATEST
+# is one cached read rather than a listing of the bucket.
+METADATA_PREFIX = 'metadata/metadata_v'  # Metadata is stored with names like "metadata_v1-0-0.json"
+METADATA_MANIFEST_KEY = 'metadata/latest.json'
+METADATA_CACHE_TTL = int(os.environ.get('METADATA_CACHE_TTL', 300))
+_metadata_cache = {}  # S3 key -> {"etag", "document", "checked_at"}
+
+# /data output formats selected with the format query parameter: name -> (Content-Type, file extension)
+OUTPUT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+PARQUET_ROW_GROUP_ROWS = 50000
+
+# Column types as declared in metadata_v1-0-0.json, used when the metadata can't be read from S3
+DEFAULT_COLUMN_TYPES = {
+    "id": "Text", "user_login": "Text", "name": "Text", "preferred_common_name": "Text",
+    "photo_url": "Text (URL)", "observed_on": "Date", "created_at": "Date and Time",
+    "latitude": "Float", "longitude": "Float", "native": "Boolean",
+}
+_column_types = None  # Resolved from the metadata on first typed request
+_column_types_expire_at = None  # Set while DEFAULT_COLUMN_TYPES stand in for metadata that couldn't be read
+
+# /data with no dates serves the last DEFAULT_WINDOW_DAYS days. A scheduled warm-up event rebuilds that
+# CSV response ahead of time; requests reuse it while it is under DEFAULT_WINDOW_MAX_AGE seconds old.
+DEFAULT_WINDOW_DAYS = 30
+DEFAULT_WINDOW_MAX_AGE = int(os.environ.get('DEFAULT_WINDOW_MAX_AGE', 900))
+_default_window = None  # {"end_date", "built_at", "response", "encoded": {encoding: bytes}}
+
+# /summary bodies are cached per date range. Within SUMMARY_CACHE_TTL seconds they are served as is; after
+# that they are reused only if the day partitions they were computed from haven't changed.
+SUMMARY_CACHE_TTL = int(os.environ.get('SUMMARY_CACHE_TTL', 300))
+SUMMARY_CACHE_ENTRIES = 64
+_summary_cache = {}  # (start_date, end_date) -> {"fingerprint", "checked_at", "body", "etag"}
+_window_cache_lock = threading.Lock()  # Requests under server.py share the per-window caches
+
+# /tiles/{z}/{x}/{y}: observation counts and top taxa on a TILE_GRID_CELLS x TILE_GRID_CELLS grid over a
+# Web Mercator (slippy map) tile. All tiles of a zoom level are binned together on first use and cached
+# with the date window, under the same rules as /summary.
+TILE_GRID_CELLS = 16
+TILE_TOP_TAXA = 3
+TILE_MAX_ZOOM = int(os.environ.get('TILE_MAX_ZOOM', 18))
+TILE_CACHE_TTL = int(os.environ.get('TILE_CACHE_TTL', 300))
+TILE_CACHE_ENTRIES = 8
+TILE_BODY_ENTRIES = 1024  # Rendered tile bodies kept per date window, least recently used dropped first
+_tile_cache = {}  # (start_date, end_date) -> {"fingerprint", "checked_at", observation columns, "zooms", "bodies"}
+
+# Per-stage timings and counters for each request. METRICS=true prints them as a CloudWatch Embedded
+# Metric Format line; SERVER_TIMING=true also returns them in a Server-Timing header. With both off the
+# instrumentation is a context variable lookup per call site.
+METRICS_ENABLED = os.environ.get('METRICS', 'false').lower() == 'true'
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING', 'false').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ChristchurchFungi')
+_request_metrics = contextvars.ContextVar('request_metrics', default=None)
+
+# Upstream HTTP client configuration
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 20))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+HTTP_BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.5))
+
+# Governor for requests to iNaturalist, which asks clients to stay around 60 requests per minute.
+# A token bucket caps the request rate (UPSTREAM_RATE_LIMIT per minute, bursts of UPSTREAM_BURST;
+# 0 turns the bucket off). The number of requests in flight starts at UPSTREAM_MAX_CONCURRENCY, halves
+# on 429 or 503, shrinks when a request is slower than UPSTREAM_LATENCY_TARGET seconds, and grows by
+# one after UPSTREAM_RECOVERY_SUCCESSES successes in a row.
+UPSTREAM_RATE_LIMIT = float(os.environ.get('UPSTREAM_RATE_LIMIT', 60))
+UPSTREAM_BURST = int(os.environ.get('UPSTREAM_BURST', 10))
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', FETCH_WORKERS))
+UPSTREAM_LATENCY_TARGET = float(os.environ.get('UPSTREAM_LATENCY_TARGET', 5))
+UPSTREAM_RECOVERY_SUCCESSES = int(os.environ.get('UPSTREAM_RECOVERY_SUCCESSES', 10))
+UPSTREAM_MAX_PAUSE = 60  # Longest pause (s) after throttling, whatever Retry-After says
+THROTTLE_STATUSES = (429, 503)
+RETRY_STATUSES = (500, 502, 504)  # Server errors fetch_page retries after a backoff
+
+# Created on first use and kept for the life of the container so warm invocations reuse connections
+_http_session = None
+_s3_client = None
+_upstream_governor = None
+_client_lock = threading.Lock()  # Fetch workers can race to create the shared clients
+
+
+class RequestMetrics:
+    # Stage timings (ms, summed across worker threads) and counters for one request
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+    
+    def add_time(self, stage, milliseconds):
+        with self.lock:
+            self.timings[stage] = self.timings.get(stage, 0.0) + milliseconds
+    
+    def add_count(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def server_timing(self):
+        return ", ".join(f"{stage};dur={milliseconds:.1f}" for stage, milliseconds in self.timings.items())
+    
+    def emf_line(self):
+        metrics = [{"Name": f"{stage}_ms", "Unit": "Milliseconds"} for stage in self.timings]
+        metrics += [{"Name": name, "Unit": "Bytes" if name.startswith('bytes') else "Count"} for name in self.counters]
+        return json.dumps({
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{"Namespace": METRICS_NAMESPACE, "Dimensions": [["Endpoint"]], "Metrics": metrics}],
+            },
+            "Endpoint": self.endpoint or "unknown",
+            **{f"{stage}_ms": round(milliseconds, 3) for stage, milliseconds in self.timings.items()},
+            **self.counters,
+        })
+
+
+@contextlib.contextmanager
+def timed(stage):
+    metrics = _request_metrics.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_time(stage, (time.perf_counter() - started) * 1000)
+
+
+def count_metric(name, value=1):
+    metrics = _request_metrics.get()
+    if metrics is not None:
+        metrics.add_count(name, value)
+
+
+def with_context(function):
+    # Run function in a copy of the caller's context so request metrics follow work onto pool threads.
+    # Call once per submission: a context can't be entered by two threads at once.
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+class UpstreamGovernor:
+    # Token bucket plus an AIMD concurrency limit shared by every thread fetching from iNaturalist
+    def __init__(self, rate_per_minute, burst, max_concurrency, latency_target, recovery_successes):
+        self.rate = rate_per_minute / 60
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.refilled_at = time.monotonic()
+        self.max_concurrency = max(max_concurrency, 1)
+        self.limit = float(self.max_concurrency)
+        self.latency_target = latency_target
+        self.recovery_successes = recovery_successes
+        self.in_flight = 0
+        self.successes = 0
+        self.throttles = 0  # Consecutive throttled responses, for the backoff when there's no Retry-After
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+    
+    def acquire(self):
+        # Block until a request may start: a concurrency slot is free, a token is available and no
+        # throttling pause is in effect
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.rate > 0:
+                    self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+                self.refilled_at = now
+                
+                waits = []
+                if now < self.paused_until:
+                    waits.append(self.paused_until - now)
+                if self.rate > 0 and self.tokens < 1:
+                    waits.append((1 - self.tokens) / self.rate)
+                if not waits and self.in_flight < int(self.limit):
+                    if self.rate > 0:
+                        self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                # With no timed wait, a slot is what's missing and release() will notify
+                self.condition.wait(max(waits) if waits else None)
+    
+    def release(self, status, latency, retry_after=None):
+        # Record how a request went and adjust the concurrency limit
+        with self.condition:
+            self.in_flight -= 1
+            if status in THROTTLE_STATUSES:
+                # Multiplicative decrease, and hold every thread back until the server is ready again
+                self.limit = max(1.0, self.limit / 2)
+                self.successes = 0
+                pause = retry_after if retry_after is not None else HTTP_BACKOFF_FACTOR * 2 ** self.throttles
+                self.paused_until = max(self.paused_until, time.monotonic() + min(pause, UPSTREAM_MAX_PAUSE))
+                self.throttles += 1
+                logger.warning(f"iNaturalist throttled a request ({status}); concurrency limit now {int(self.limit)}, pausing {pause:.1f}s")
+            elif status is None or status in RETRY_STATUSES or latency > self.latency_target:
+                # Timed out, failed or slow: the server is struggling, ease off gently
+                self.limit = max(1.0, self.limit * 0.75)
+                self.successes = 0
+            else:
+                self.throttles = 0
+                self.successes += 1
+                if self.successes >= self.recovery_successes and self.limit < self.max_concurrency:
+                    self.limit = min(float(self.max_concurrency), int(self.limit) + 1.0)  # Additive increase
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+class ChunkSink:
+    # Write-only file for pyarrow that hands back what has been written since the last drain. tell()
+    # keeps counting from the start, since the Parquet footer records offsets into the whole file.
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.position
+    
+    def writable(self):
+        return True
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.closed = True
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+class UpstreamError(Exception):
+    # Raised when iNaturalist returns a non-200 page; carries the status and body through to the response
+    def __init__(self, status_code, body):
+        super().__init__(f"iNaturalist returned status {status_code}")
+        self.status_code = status_code
+        self.body = body
+
+def lazy_import(module_name):
+    # Always go through importlib: a module another thread is still importing is already in
+    # sys.modules, and importlib knows to wait for it to finish
+    already_loaded = module_name in sys.modules
+    started = time.perf_counter()
+    module = importlib.import_module(module_name)
+    if not already_loaded:
+        import_times[module_name] = (time.perf_counter() - started) * 1000
+        if IMPORT_TIME_REPORT:
+            logger.info(f"Imported {module_name} in {import_times[module_name]:.1f} ms")
+    return module
+
+
+def attach_file_handler():
+    global file_handler
+    if file_handler is not None:
+        return
+    with _client_lock:  # Concurrent first requests under server.py must not attach two handlers
+        if file_handler is None:
+            handler = logging.FileHandler(log_file)
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            handler.setFormatter(formatter)
+            logger.addHandler(handler)
+            file_handler = handler
+
 
 def lambda_handler(event, context):
+    attach_file_handler()
     logger.info("Lambda function started")
+    ship_logs = True
+    response = None
+    metrics = None
+    if METRICS_ENABLED or SERVER_TIMING_ENABLED:
+        metrics = RequestMetrics(event.get('requestContext', {}).get("path"))
+        metrics_token = _request_metrics.set(metrics)
     try:
+        # Maintenance events invoked directly (e.g. by a scheduled rule), never through API Gateway
+        if event.get('action') == 'compact_logs' and 'requestContext' not in event:
+            day = date.fromisoformat(event['date']) if event.get('date') else datetime.now(timezone.utc).date() - timedelta(days=1)
+            compacted = compact_log_segments(day)
+            response = {
+                "statusCode": 200,
+                "body": json.dumps({"date": day.isoformat(), "compacted_segments": compacted})
+            }
+            return response
+        if (event.get('action') == 'warm_up' or event.get('detail-type') == 'Scheduled Event') and 'requestContext' not in event:
+            response = {
+                "statusCode": 200,
+                "body": json.dumps(warm_default_window())
+            }
+            return response
+        if event.get('action') == 'update_metadata_manifest' and 'requestContext' not in event:
+            manifest = update_metadata_manifest()
+            response = {
+                "statusCode": 200 if manifest else 404,
+                "body": json.dumps(manifest or {"error": "No metadata versions found"})
+            }
+            return response
+        
         # Parse query parameters from the event
         query_params = event.get('queryStringParameters', {})
         endpoint = event.get('requestContext', {}).get("path")  # returns the endpoint path
+        encoding = negotiate_encoding(event.get('headers'))
+        if_none_match = header_value(event.get('headers'), 'if-none-match')
+        remaining_ms = context.get_remaining_time_in_millis() if hasattr(context, 'get_remaining_time_in_millis') else None
         
         # Check for API key
         api_key = query_params.get('api_key', "")
         if api_key != os.environ.get('API_KEY'):
             logger.warning("Unauthorized access attempt with invalid API key")
-            return {
+            ship_logs = False  # Still reaches CloudWatch; not worth an S3 round trip (or importing boto3)
+            response = {
                 "statusCode": 401,
                 "body": json.dumps({"error": "Unauthorised. Invalid API key."})
             }
+            return response
         
         if endpoint == '/metadata':
             logger.info("Endpoint '/metadata' accessed")
             # Return data from iNaturalist
-            response = get_metadata_table(query_params)
+            with timed('metadata'):
+                response = get_metadata_table(query_params, if_none_match)
+            with timed('compress'):
+                response = compress_response(response, encoding, remaining_ms)
+        
+        elif endpoint == '/summary':
+            logger.info("Endpoint '/summary' accessed")
+            response = get_observation_summary(query_params, if_none_match)
+            with timed('compress'):
+                response = compress_response(response, encoding, remaining_ms)
+        
+        elif endpoint and endpoint.startswith('/tiles/'):
+            logger.info(f"Endpoint '{endpoint}' accessed")
+            response = get_observation_tile(endpoint, query_params, if_none_match)
+            with timed('compress'):
+                response = compress_response(response, encoding, remaining_ms)
         
         elif endpoint == '/data':
             logger.info("Endpoint '/data' accessed")
             # Return metadata table
-            response = get_observation_data(query_params)
+            response = get_observation_data(query_params, encoding, remaining_ms, if_none_match)
         
         else:
             logger.error("Invalid endpoint accessed")
@@ -51,6 +482,9 @@ def lambda_handler(event, context):
             }
         
         logger.info("Lambda function executed successfully")
+        if metrics is not None and SERVER_TIMING_ENABLED:
+            metrics.add_time('total', (time.perf_counter() - metrics.started) * 1000)
+            response['headers'] = {**response.get('headers', {}), "Server-Timing": metrics.server_timing()}
         return response
 
     except Exception as e:
@@ -61,49 +495,284 @@ def lambda_handler(event, context):
         }
 
     finally:
-        upload_log_to_s3()
+        if IMPORT_TIME_REPORT and import_times:
+            logger.info(f"Import time report (ms): {json.dumps({name: round(ms, 1) for name, ms in import_times.items()})}")
+            import_times.clear()  # Report each import once, on the invocation that paid for it
+        if ship_logs:
+            with timed('log_shipping'):
+                upload_log_to_s3(getattr(context, 'aws_request_id', None))
+        if metrics is not None:
+            _request_metrics.reset(metrics_token)
+            if METRICS_ENABLED:
+                if 'total' not in metrics.timings:
+                    metrics.add_time('total', (time.perf_counter() - metrics.started) * 1000)
+                if response is not None and isinstance(response.get('body'), str):
+                    metrics.add_count('bytes_out', response_bytes(response))
+                print(metrics.emf_line())  # CloudWatch extracts metrics from EMF lines on stdout
 
-def transform_version(version):
-    # Transform version from v1.0.0 to 1-0-0
-    return version[1:].replace('.', '-')
+def response_bytes(response):
+    # Size of the body as sent: UTF-8 for text, the decoded payload for base64-encoded bodies
+    if response.get('isBase64Encoded'):
+        body = response['body']
+        return len(body) * 3 // 4 - body[-2:].count('=')
+    return len(response['body'].encode('utf-8'))
 
-def get_metadata_table(query_params):
-    # Parse metadata_version from query parameters
-    metadata_version = query_params.get('metadata_version', 'LATEST')
 
-    if metadata_version != 'LATEST':
-        metadata_version = transform_version(metadata_version)
+def negotiate_encoding(headers):
+    # Pick gzip or deflate from Accept-Encoding (honouring q-values); None means send plain text
+    if not COMPRESSION_ENABLED or not headers:
+        return None
+    accept_encoding = next((value for name, value in headers.items() if name.lower() == 'accept-encoding'), '')
     
-    # Retrieve metadata from S3 based on the specified version
-    s3 = boto3.client('s3')
-    bucket_name = os.environ.get('S3_BUCKET_NAME')
-    prefix = 'metadata/metadata_v'  # Metadata is stored with names like "metadata_v1-0-0.json"
+    preferences = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        preferences[coding.strip().lower()] = quality
+    
+    candidates = [(preferences.get(coding, preferences.get('*', 0.0)), coding) for coding in ('gzip', 'deflate')]
+    quality, coding = max(candidates, key=lambda candidate: candidate[0])  # gzip wins ties
+    return coding if quality > 0 else None
 
-    if metadata_version == 'LATEST':
-        # List objects in the metadata folder
-        response = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-        
-        # Extract version numbers from object keys
-        versions = [re.findall(r'metadata_v(\d+-\d+-\d+)', obj['Key'])[0] for obj in response.get('Contents', []) if 'Key' in obj]
-        
-        # Find the latest version
-        latest_version = max(versions)
-        
-        # Construct key for the latest metadata file
-        key = f'{prefix}{latest_version}.json'
 
+def inline_body_bytes(size_hint, output_format, encoding):
+    # Estimated size of a body as it would be returned inline, from the estimated size of the unencoded
+    # body: compressed and Parquet bodies are smaller, but base64-encoded
+    if output_format == 'parquet':
+        return size_hint * 4 // 3
+    if encoding is not None and size_hint >= COMPRESSION_MIN_BYTES:
+        return int(size_hint * ESTIMATED_COMPRESSION_RATIO) * 4 // 3
+    return size_hint
+
+
+def compression_level(size_hint, remaining_ms=None):
+    # Spend more CPU on small bodies where it is cheap, less on big ones, and the least when time is short
+    if remaining_ms is not None and remaining_ms < COMPRESSION_FAST_MS:
+        return 1
+    if size_hint < 256 * 1024:
+        return 9
+    if size_hint < 2 * 1024 * 1024:
+        return 6
+    return 4
+
+
+def compress_chunks(chunks, encoding, level):
+    # Compress text chunks as they are produced so the full uncompressed body is never held in memory
+    wbits = zlib.MAX_WBITS | 16 if encoding == 'gzip' else zlib.MAX_WBITS  # HTTP deflate is zlib-wrapped
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    compressed = []
+    for chunk in chunks:
+        with timed('compress'):
+            compressed.append(compressor.compress(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')))
+    with timed('compress'):
+        compressed.append(compressor.flush())
+    return b''.join(compressed)
+
+
+def encoded_response(response, body, encoding):
+    response['headers'] = {**response.get('headers', {}), "Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+    if 'ETag' in response['headers']:
+        response['headers']['ETag'] = representation_etag(response['headers']['ETag'].strip('"'), encoding)
+    response['body'] = base64.b64encode(body).decode('ascii')
+    response['isBase64Encoded'] = True
+    return response
+
+
+def compress_response(response, encoding, remaining_ms=None):
+    body = response.get('body')
+    if encoding is None or response.get('statusCode') != 200 or not isinstance(body, str):
+        return response
+    if len(body) < COMPRESSION_MIN_BYTES:
+        return response
+    level = compression_level(len(body), remaining_ms)
+    return encoded_response(response, compress_chunks([body], encoding, level), encoding)
+
+
+def header_value(headers, name):
+    # API Gateway passes header names as the client sent them
+    return next((value for key, value in (headers or {}).items() if key.lower() == name), None)
+
+
+def representation_etag(tag, encoding=None):
+    # A compressed body is a different representation, so it gets its own strong ETag
+    return f'"{tag}-{encoding}"' if encoding else f'"{tag}"'
+
+
+def etag_matches(if_none_match, tag):
+    # When an If-None-Match entry matches tag (in any encoding), the strong ETag of that representation
+    # to send with the 304; otherwise None. If-None-Match uses weak comparison.
+    for entry in (if_none_match or '').split(','):
+        entry = entry.strip()
+        if entry == '*':
+            return representation_etag(tag)
+        candidate = (entry[2:] if entry.startswith('W/') else entry).strip('"')
+        for coding in (None, 'gzip', 'deflate'):
+            if candidate == representation_etag(tag, coding).strip('"'):
+                return representation_etag(tag, coding)
+    return None
+
+
+def not_modified(etag):
+    return {
+        "statusCode": 304,
+        "headers": {"ETag": etag, "Vary": "Accept-Encoding"},
+        "body": ""
+    }
+
+
+def parse_metadata_version(version):
+    # "v1.10.0", "1.10.0" or "1-10-0" -> (1, 10, 0), compared numerically so 1.10.0 sorts after 1.9.0.
+    # None if it isn't a version.
+    match = re.fullmatch(r'v?(\d+)[.-](\d+)[.-](\d+)', version.strip())
+    return tuple(int(part) for part in match.groups()) if match else None
+
+
+def format_metadata_version(version):
+    return '.'.join(str(part) for part in version)
+
+
+def metadata_key(version):
+    return f"{METADATA_PREFIX}{'-'.join(str(part) for part in version)}.json"
+
+
+def read_metadata_object(key):
+    # JSON document at key, served from memory while fresh and revalidated with If-None-Match after that.
+    # Raises botocore's ClientError (NoSuchKey) if the object doesn't exist.
+    botocore_exceptions = lazy_import('botocore.exceptions')
+    cached = _metadata_cache.get(key)
+    now = time.time()
+    if cached and now - cached['checked_at'] < METADATA_CACHE_TTL:
+        return cached['document']
+    
+    request = {"Bucket": os.environ.get('S3_BUCKET_NAME'), "Key": key}
+    if cached:
+        request['IfNoneMatch'] = cached['etag']
+    try:
+        response = get_s3_client().get_object(**request)
+    except botocore_exceptions.ClientError as e:
+        error_code = e.response.get('Error', {}).get('Code')
+        if not cached or error_code in ('404', 'NoSuchKey'):
+            raise
+        if error_code not in ('304', 'NotModified'):
+            logger.warning(f"Error revalidating {key}, serving the cached copy: {str(e)}")
+        cached['checked_at'] = now
+        return cached['document']
+    except botocore_exceptions.BotoCoreError as e:
+        if not cached:
+            raise
+        logger.warning(f"Error revalidating {key}, serving the cached copy: {str(e)}")
+        cached['checked_at'] = now
+        return cached['document']
+    
+    document = json.loads(response['Body'].read())
+    _metadata_cache[key] = {"etag": response['ETag'], "document": document, "checked_at": now}
+    return document
+
+
+def list_metadata_versions():
+    # Every published metadata version as a (major, minor, patch) tuple, oldest first
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    pattern = re.compile(re.escape(METADATA_PREFIX) + r'(\d+-\d+-\d+)\.json')
+    versions = []
+    for page in paginator.paginate(Bucket=os.environ.get('S3_BUCKET_NAME'), Prefix=METADATA_PREFIX):
+        for obj in page.get('Contents', []):
+            match = pattern.fullmatch(obj['Key'])
+            if match:
+                versions.append(parse_metadata_version(match.group(1)))
+    return sorted(versions)
+
+
+def update_metadata_manifest():
+    # Rewrite metadata/latest.json from a listing of the published versions. Returns the manifest,
+    # or None if no versions have been published.
+    versions = list_metadata_versions()
+    if not versions:
+        return None
+    manifest = {
+        "latest": format_metadata_version(versions[-1]),
+        "key": metadata_key(versions[-1]),
+        "versions": [format_metadata_version(version) for version in versions],
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }
+    botocore_exceptions = lazy_import('botocore.exceptions')
+    try:
+        get_s3_client().put_object(
+            Bucket=os.environ.get('S3_BUCKET_NAME'),
+            Key=METADATA_MANIFEST_KEY,
+            Body=json.dumps(manifest, indent=2).encode('utf-8'),
+            ContentType='application/json',
+        )
+        _metadata_cache.pop(METADATA_MANIFEST_KEY, None)
+        logger.info(f"Metadata manifest updated, latest version {manifest['latest']}")
+    except (botocore_exceptions.BotoCoreError, botocore_exceptions.ClientError) as e:
+        logger.warning(f"Error writing the metadata manifest: {str(e)}")
+    return manifest
+
+
+def resolve_latest_metadata_key():
+    # Key of the newest metadata version, from the manifest. The manifest is built on first use.
+    botocore_exceptions = lazy_import('botocore.exceptions')
+    try:
+        return read_metadata_object(METADATA_MANIFEST_KEY)['key']
+    except botocore_exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+            raise
+    logger.info("No metadata manifest found, building one from the published versions")
+    manifest = update_metadata_manifest()
+    return manifest['key'] if manifest else None
+
+
+def get_metadata_table(query_params, if_none_match=None):
+    # Parse metadata_version from query parameters
+    metadata_version = query_params.get('metadata_version', 'LATEST')
+    
+    if metadata_version == 'LATEST':
+        version = None
     else:
-        key = f'{prefix}{metadata_version}.json'
+        version = parse_metadata_version(metadata_version)
+        if version is None:
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": "Invalid metadata_version. Use LATEST or a version like v1.0.0."})
+            }
     
+    # Retrieve metadata from S3 (or the in-memory cache) based on the specified version
+    botocore_exceptions = lazy_import('botocore.exceptions')
     try:
-        response = s3.get_object(Bucket=bucket_name, Key=key)
-        metadata_json = json.loads(response['Body'].read())
+        key = resolve_latest_metadata_key() if version is None else metadata_key(version)
+        metadata_json = read_metadata_object(key) if key else None
         logger.info("Metadata retrieved successfully")
+    except botocore_exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+            return {
+                "statusCode": 500,
+                "body": json.dumps({"error": str(e)})
+            }
+        metadata_json = None
     except Exception as e:
         return {
             "statusCode": 500,
             "body": json.dumps({"error": str(e)})
         }
+    
+    if metadata_json is None:
+        return {
+            "statusCode": 404,
+            "body": json.dumps({"error": f"Metadata version {metadata_version} not found"})
+        }
+    
+    # The version file name plus its S3 ETag identifies the body
+    object_etag = _metadata_cache[key]['etag'].strip('"')
+    etag = f"{key[len(METADATA_PREFIX):-len('.json')]}-{object_etag}"
+    matched = etag_matches(if_none_match, etag)
+    if matched:
+        logger.info("Metadata not modified")
+        return not_modified(matched)
 
     # Convert metadata JSON to string
     metadata_str = json.dumps(metadata_json, indent=4)
@@ -112,15 +781,15 @@ def get_metadata_table(query_params):
         "statusCode": 200,
         "headers": {
             "Content-Type": "application/json",
-            "Content-Disposition": f"attachment; filename=metadata.json"
+            "Content-Disposition": f"attachment; filename=metadata.json",
+            "ETag": representation_etag(etag),
         },
         "body": metadata_str
     }
 
 
-def get_observation_data(query_params):
-    
-    # Parse start_date and end_date from query parameters
+def parse_date_range(query_params):
+    # start_date/end_date query parameters -> (start_date, end_date, error response)
     start_date_str = query_params.get('start_date', '')
     end_date_str = query_params.get('end_date', '')
     
@@ -132,14 +801,14 @@ def get_observation_data(query_params):
         
         except ValueError:
             logger.error("Invalid date format")
-            return {
+            return None, None, {
                 "statusCode": 400,
                 "body": json.dumps({"error": "Invalid date format. Please use YYYY-MM-DD."})
             }
         
         if end_date <= start_date:
             logger.error("End date must be after start date")
-            return {
+            return None, None, {
                 "statusCode": 400,
                 "body": json.dumps({"error": "End date must be after start date."})
             }
@@ -147,18 +816,21 @@ def get_observation_data(query_params):
     elif (start_date_str and not end_date_str) or (end_date_str and not start_date_str):
         # If only one date is given, state that both are required.
         logger.error("Both start date and end date must be provided")
-        return {
+        return None, None, {
             "statusCode": 400,
             "body": json.dumps({"error": "End date and start date must both be given."})
         }
 
     else:
         # If no dates are provided, use default values (e.g., past 30 days)
-        start_date = datetime.now().date() - timedelta(days=30)
+        start_date = datetime.now().date() - timedelta(days=DEFAULT_WINDOW_DAYS)
         end_date = datetime.now().date()
     
-    # Construct params for iNaturalist API
+    return start_date, end_date, None
 
+
+def observation_params(start_date, end_date):
+    # Construct params for iNaturalist API
     params = {
         "place_id": 40469,  # Christchurch, New Zealand place ID
         "iconic_taxa": "Fungi",
@@ -170,103 +842,1882 @@ def get_observation_data(query_params):
         "d2": end_date.isoformat(),
         "quality_grade": "research"  # Retrieve only verified observations
     }
+    return params
 
-    logger.info(f"API input parameters: {params}")
+
+def get_observation_data(query_params, encoding=None, remaining_ms=None, if_none_match=None, use_materialized=True):
     
-    observations = []  # List to store all observations
+    output_format = query_params.get('format', 'csv').lower()
+    if output_format not in OUTPUT_FORMATS:
+        logger.error(f"Unsupported output format: {output_format}")
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": f"Unsupported format. Please use one of: {', '.join(OUTPUT_FORMATS)}."})
+        }
     
-    # Continue making requests until all pages are fetched
-    while True:
-        # Make request to iNaturalist API
-        response = requests.get("https://api.inaturalist.org/v1/observations", params=params)
+    filters, filter_error = parse_observation_filters(query_params)
+    if filter_error:
+        logger.error(f"Invalid filter: {filter_error}")
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": filter_error})
+        }
+    
+    # Parse start_date and end_date from query parameters
+    start_date_str = query_params.get('start_date', '')
+    end_date_str = query_params.get('end_date', '')
+    
+    if use_materialized and not start_date_str and not end_date_str and output_format == 'csv' and not filters:
+        materialized = _default_window
+        if materialized is not None and default_window_is_current(materialized):
+            logger.info(f"Serving the default window materialized {time.time() - materialized['built_at']:.0f}s ago")
+            return serve_default_window(materialized, encoding, if_none_match)
+    
+    start_date, end_date, error_response = parse_date_range(query_params)
+    if error_response:
+        return error_response
+    
+    params = observation_params(start_date, end_date)
+    logger.info(f"API input parameters: {params}")
+    
+    # The body is produced by a generator pipeline: fetch a page -> project its rows -> encode a chunk.
+    # Each page is dropped once its chunk is written, so memory is bounded by a page, not the range.
+    stats = {"rows": 0}
+    try:
+        row_pages = None
+        if filters and OBSERVATION_CACHE_ENABLED and OBSERVATION_STORE_ENABLED:
+            # Answered from the indexed store; only days that changed are loaded into it
+            row_pages = query_observation_store(params, start_date, end_date, filters, stats)
+        if row_pages is None:
+            row_pages = iter_row_pages(open_observation_stream(params, start_date, end_date, stats))
+            if filters:
+                # The same filters, row by row. params stay unfiltered, so the partition cache only ever
+                # holds whole days; stats['expected_rows'] is then an upper bound.
+                row_pages = filter_row_pages(row_pages, filters)
         
-        # Process  response data
-        if response.status_code == 200:
-            data = response.json().get('results', [])
-            observations.extend(data)  # Add observations from current page
-            
-            # Check if there is more than one page
-            if response.json().get('total_results', 0) > len(observations):
-                params['page'] += 1  # Move to the next page
-            else:
-                break  # No more pages, break the loop
+        size_hint = int(stats.get('expected_rows', 0) * ESTIMATED_ROW_BYTES * ESTIMATED_FORMAT_RATIOS[output_format])
+        offload = (OFFLOAD_ENABLED and os.environ.get('S3_BUCKET_NAME')
+                   and inline_body_bytes(size_hint, output_format, encoding) >= OFFLOAD_THRESHOLD_BYTES)
+        
+        # With the observation cache the ETag comes from the partitions and is known before anything is
+        # serialized. Otherwise it is a hash of the body, which only saves sending it. Offloaded results
+        # are never tagged: their body is a download link that expires, so it must not be reused.
+        etag = None
+        digest = None
+        if stats.get('fingerprint') and not offload:
+            etag_source = f"{output_format}|{DATA_METADATA_VERSION}|{stats['fingerprint']}|{json.dumps(filters, sort_keys=True)}"
+            etag = hashlib.blake2b(etag_source.encode('utf-8'), digest_size=16).hexdigest()
+            matched = etag_matches(if_none_match, etag)
+            if matched:
+                logger.info("Observation data not modified")
+                return not_modified(matched)
+        elif not offload:
+            digest = hashlib.blake2b(digest_size=16)
+        
+        chunks = iter_output_chunks(output_format, row_pages, stats)
+        if digest is not None:
+            chunks = iter_hashed(chunks, digest)
+        content_type, extension = OUTPUT_FORMATS[output_format]
+        
+        # Prepare response
+        response_body = {
+            "statusCode": 200,
+            "headers": {
+                "Content-Type": content_type,
+                "Content-Disposition": f"attachment; filename=inaturalist_observations.{extension}",
+                "metadata_version": DATA_METADATA_VERSION,  # Metadata version information here
+            },
+        }
+        if etag:
+            response_body['headers']['ETag'] = representation_etag(etag)
+        
+        if offload:
+            response_body = offload_observation_data(chunks, stats, output_format)
+        
+        elif output_format == 'parquet':
+            # Binary, and already compressed column by column, so it is only base64-encoded
+            response_body['body'] = base64.b64encode(b''.join(chunks)).decode('ascii')
+            response_body['isBase64Encoded'] = True
+        
+        elif encoding is not None and size_hint >= COMPRESSION_MIN_BYTES:
+            # Feed chunks straight into the compressor rather than building the whole body first
+            level = compression_level(size_hint, remaining_ms)
+            response_body = encoded_response(response_body, compress_chunks(chunks, encoding, level), encoding)
         
         else:
-            logger.error(f"Error retrieving observation data: {response.status_code}")
-            return {
-                "statusCode": response.status_code,
-                "body": response.text
-            }
+            # Serialize straight to text, without building a DataFrame (or importing pandas)
+            response_body['body'] = ''.join(chunks)
+        
+        if digest is not None:
+            etag = digest.hexdigest()
+            matched = etag_matches(if_none_match, etag)
+            if matched:
+                logger.info("Observation data not modified")
+                return not_modified(matched)
+            response_body['headers']['ETag'] = representation_etag(etag, response_body['headers'].get('Content-Encoding'))
+    
+    except UpstreamError as e:
+        return {
+            "statusCode": e.status_code,
+            "body": e.body
+        }
+    
+    logger.info(f"Observation data retrieved successfully. Number of observations: {stats['rows']}")
+    return response_body
+
+
+def parse_observation_filters(query_params):
+    # Optional /data filters. Returns (filters, error message).
+    filters = {}
+    if (query_params.get('taxon') or '').strip():
+        filters['taxon'] = query_params['taxon'].strip()
+    if (query_params.get('user') or '').strip():
+        filters['user'] = query_params['user'].strip()
+    if query_params.get('native'):
+        native = query_params['native'].lower()
+        if native not in ('true', 'false'):
+            return None, "native must be true or false."
+        filters['native'] = native == 'true'
+    if query_params.get('bbox'):
+        try:
+            min_lng, min_lat, max_lng, max_lat = (float(value) for value in query_params['bbox'].split(','))
+        except ValueError:
+            return None, "bbox must be min_longitude,min_latitude,max_longitude,max_latitude."
+        if min_lat > max_lat or min_lng > max_lng:
+            return None, "bbox minimums must not exceed its maximums."
+        filters['bbox'] = [min_lng, min_lat, max_lng, max_lat]
+    return filters, None
+
+
+def row_matches_filters(row, filters):
+    # What each filter means, on one CSV_COLUMNS row. query_observation_store's SQL is the same test over
+    # the store's key columns, so a request gives the same rows with or without the store.
+    if 'taxon' in filters:
+        # The scientific name itself or any name below it ('Amanita' -> 'Amanita muscaria' ->
+        # 'Amanita muscaria flavivolvata': the name followed by a space, and '!' sorts just after ' '),
+        # or exactly the common name. Case-insensitive.
+        taxon = filters['taxon'].lower()
+        if not (taxon <= row[6].lower() < taxon + '!' or row[7].lower() == taxon):
+            return False
+    if 'user' in filters and row[4].lower() != filters['user'].lower():
+        return False
+    if 'native' in filters and not (isinstance(row[8], bool) and row[8] == filters['native']):
+        return False
+    if 'bbox' in filters:
+        min_lng, min_lat, max_lng, max_lat = filters['bbox']
+        latitude, longitude = to_float(row[2]), to_float(row[3])
+        if latitude is None or longitude is None:
+            return False
+        if not (min_lat <= latitude <= max_lat and min_lng <= longitude <= max_lng):
+            return False
+    return True
+
+
+def filter_row_pages(row_pages, filters):
+    for page in row_pages:
+        yield [row for row in page if row_matches_filters(row, filters)]
+
+
+def open_observation_store():
+    sqlite3 = lazy_import('sqlite3')
+    connection = sqlite3.connect(OBSERVATION_STORE_PATH, timeout=30)
+    try:
+        prepare_observation_store(connection)
+    except Exception:
+        connection.close()
+        raise
+    return connection
+
+
+def prepare_observation_store(connection):
+    connection.execute("PRAGMA journal_mode=WAL")  # Readers don't wait for a day being reloaded
+    connection.execute("BEGIN IMMEDIATE")  # One connection at a time checks the schema
+    if connection.execute("PRAGMA user_version").fetchone()[0] != STORE_SCHEMA_VERSION:
+        # New file, or one written by an older version: the store is only a copy of the partitions
+        connection.execute("DROP TABLE IF EXISTS observations")
+        connection.execute("DROP TABLE IF EXISTS store_days")
+        connection.execute("CREATE TABLE store_days (day TEXT PRIMARY KEY, content_hash TEXT NOT NULL, used_at REAL NOT NULL)")
+        connection.execute("""
+            CREATE TABLE observations (
+                id INTEGER PRIMARY KEY,
+                day TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                name_key TEXT NOT NULL,
+                common_name_key TEXT NOT NULL,
+                user_key TEXT NOT NULL,
+                native INTEGER,
+                latitude REAL,
+                longitude REAL,
+                row TEXT NOT NULL
+            )
+        """)
+        connection.execute("CREATE INDEX observations_day ON observations (day, position)")
+        connection.execute("CREATE INDEX observations_name ON observations (name_key, day)")
+        connection.execute("CREATE INDEX observations_common_name ON observations (common_name_key, day)")
+        connection.execute("CREATE INDEX observations_user ON observations (user_key, day)")
+        connection.execute("CREATE INDEX observations_native ON observations (native, day)")
+        connection.execute("CREATE INDEX observations_location ON observations (latitude, longitude)")
+        connection.execute("CREATE INDEX store_days_used ON store_days (used_at)")
+        connection.execute(f"PRAGMA user_version = {STORE_SCHEMA_VERSION}")
+    connection.commit()
+
+
+def store_record(day, position, row):
+    # Filter columns next to the row itself, kept as JSON so it reads back exactly as flattened. Text
+    # keys are lowercased here, as row_matches_filters does, rather than by a SQLite collation.
+    latitude, longitude = to_float(row[2]), to_float(row[3])
+    native = row[8] if isinstance(row[8], bool) else None
+    return (row[0], day, position, row[6].lower(), row[7].lower(), row[4].lower(), native, latitude, longitude, json.dumps(row))
+
+
+def load_observation_store(connection, params, start_date, end_date, stats):
+    # Bring every day in the range up to date with the partition cache, reloading only the days whose
+    # content hash differs from the copy in the store, and drop days that have gone unused too long
+    pages = iter_observations_cached(params, start_date, end_date, stats)
+    try:
+        first_page = next(pages, None)  # Resolves every partition and fills in stats['content_hashes']
+        content_hashes = stats['content_hashes']
+        days = date_range(start_date, end_date)
+        stored = {day: (content_hash, used_at) for day, content_hash, used_at in connection.execute(
+            "SELECT day, content_hash, used_at FROM store_days WHERE day BETWEEN ? AND ?",
+            (start_date.isoformat(), end_date.isoformat()),
+        )}
+        now = time.time()
+        changed = {day for day in days if stored.get(day.isoformat(), (None, 0))[0] != content_hashes[day]}
+        touched = [day.isoformat() for day in days
+                   if day not in changed and now - stored[day.isoformat()][1] >= STORE_TOUCH_INTERVAL]
+        if not changed and not touched:
+            return
+        
+        with connection:
+            if changed:
+                logger.info(f"Loading {len(changed)} of {len(days)} days into the observation store")
+                oldest_changed = min(changed)
+                # Partitions come newest day first; stop once the oldest changed day is loaded
+                for day, observations in zip(reversed(days), itertools.chain([first_page], pages)):
+                    if day in changed:
+                        connection.execute("DELETE FROM observations WHERE day = ?", (day.isoformat(),))
+                        connection.executemany(
+                            "INSERT OR REPLACE INTO observations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (store_record(day.isoformat(), position, observation_row(obs)) for position, obs in enumerate(observations)),
+                        )
+                        connection.execute("INSERT OR REPLACE INTO store_days VALUES (?, ?, ?)", (day.isoformat(), content_hashes[day], now))
+                    if day == oldest_changed:
+                        break
+            connection.executemany("UPDATE store_days SET used_at = ? WHERE day = ?", ((now, day) for day in touched))
+            prune_observation_store(connection, now)
+    finally:
+        pages.close()
+    
+    if changed:
+        # Refresh the statistics the query planner uses to pick between the day, name and user indexes
+        connection.execute("PRAGMA analysis_limit=1000")
+        connection.execute("ANALYZE")
+
+
+def prune_observation_store(connection, now):
+    # Drop the rows of days no request has read within OBSERVATION_STORE_RETENTION seconds
+    expired = [day for (day,) in connection.execute(
+        "SELECT day FROM store_days WHERE used_at < ?", (now - OBSERVATION_STORE_RETENTION,))]
+    if not expired:
+        return
+    connection.executemany("DELETE FROM observations WHERE day = ?", ((day,) for day in expired))
+    connection.executemany("DELETE FROM store_days WHERE day = ?", ((day,) for day in expired))
+    logger.info(f"Dropped {len(expired)} days unused for {OBSERVATION_STORE_RETENTION}s from the observation store")
+
+
+def query_observation_store(params, start_date, end_date, filters, stats):
+    # Pages of rows matching filters, newest day first as in the unfiltered output. Returns None if
+    # the store can't be used, so the caller can filter the rows itself.
+    sqlite3 = lazy_import('sqlite3')
+    conditions = ["day BETWEEN ? AND ?"]
+    arguments = [start_date.isoformat(), end_date.isoformat()]
+    # Each condition is the SQL form of the same test in row_matches_filters
+    if 'taxon' in filters:
+        taxon = filters['taxon'].lower()
+        conditions.append("((name_key >= ? AND name_key < ?) OR common_name_key = ?)")
+        arguments += [taxon, taxon + '!', taxon]
+    if 'user' in filters:
+        conditions.append("user_key = ?")
+        arguments.append(filters['user'].lower())
+    if 'native' in filters:
+        conditions.append("native = ?")
+        arguments.append(int(filters['native']))
+    if 'bbox' in filters:
+        min_lng, min_lat, max_lng, max_lat = filters['bbox']
+        conditions.append("latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?")
+        arguments += [min_lat, max_lat, min_lng, max_lng]
+    where = " AND ".join(conditions)
+    
+    connection = None
+    cursor = None
+    try:
+        connection = open_observation_store()
+        with timed('store'):
+            load_observation_store(connection, params, start_date, end_date, stats)
+            stats['expected_rows'] = connection.execute(f"SELECT COUNT(*) FROM observations WHERE {where}", arguments).fetchone()[0]
+            cursor = connection.execute(f"SELECT row FROM observations WHERE {where} ORDER BY day DESC, position", arguments)
+    except sqlite3.Error as e:
+        logger.warning(f"Observation store unavailable, filtering the rows directly instead: {str(e)}")
+        stats.pop('fingerprint', None)
+        return None
+    finally:
+        # Unless the cursor was handed on to iter_store_pages (which closes the connection when done),
+        # close it here, whatever went wrong (an UpstreamError while loading included)
+        if cursor is None and connection is not None:
+            connection.close()
+    logger.info(f"Observation store: {stats['expected_rows']} observations match {filters}")
+    return iter_store_pages(connection, cursor)
+
+
+def iter_store_pages(connection, cursor):
+    try:
+        while True:
+            with timed('store'):
+                records = cursor.fetchmany(STORE_PAGE_ROWS)
+                if not records:
+                    return
+                page = [tuple(json.loads(record[0])) for record in records]
+            yield page
+    finally:
+        connection.close()
+
+
+def get_observation_summary(query_params, if_none_match=None):
+    # Counts per species, day and week plus first and last sightings, for dashboards that don't need rows
+    start_date, end_date, error_response = parse_date_range(query_params)
+    if error_response:
+        return error_response
     
-    df = process_data(observations)
+    def build(row_pages):
+        with timed('summarize'):
+            summary = summarize_observations(row_pages)
+        body = json.dumps({"start_date": start_date.isoformat(), "end_date": end_date.isoformat(), **summary})
+        return {"body": body, "etag": hashlib.blake2b(body.encode('utf-8'), digest_size=16).hexdigest()}
     
-    # Convert DataFrame to CSV
-    csv_data = df.to_csv(index=False)
-    logger.info(f"Observation data retrieved successfully. Number of observations: {len(observations)}")
+    try:
+        cached = cached_for_window(_summary_cache, SUMMARY_CACHE_ENTRIES, SUMMARY_CACHE_TTL, start_date, end_date, build)
+    except UpstreamError as e:
+        return {
+            "statusCode": e.status_code,
+            "body": e.body
+        }
     
-    # Prepare response
-    response_body = {
+    matched = etag_matches(if_none_match, cached['etag'])
+    if matched:
+        return not_modified(matched)
+    return {
         "statusCode": 200,
         "headers": {
-            "Content-Type": "text/csv",
-            "Content-Disposition": f"attachment; filename=inaturalist_observations.csv",
-            "metadata_version": "1.0.0",  # Metadata version information here
+            "Content-Type": "application/json",
+            "ETag": representation_etag(cached['etag']),
         },
-        "body": csv_data,
+        "body": cached['body']
     }
+
+
+def cached_for_window(cache, max_entries, ttl, start_date, end_date, build):
+    # The cache entry for a date window, made by build(row_pages) when missing or out of date. Within ttl
+    # seconds an entry is returned as is; after that it is kept while the day partitions it was built
+    # from are unchanged (without the observation cache there is nothing to compare, so it is rebuilt).
+    key = (start_date, end_date)
+    with _window_cache_lock:
+        cached = cache.get(key)
+        if cached is not None and time.time() - cached['checked_at'] < ttl:
+            return cached
     
-    return response_body
+    stats = {"rows": 0}
+    pages = open_observation_stream(observation_params(start_date, end_date), start_date, end_date, stats)
+    fingerprint = stats.get('fingerprint')
+    if cached is not None and fingerprint and cached['fingerprint'] == fingerprint:
+        with _window_cache_lock:  # Eviction picks the entry with the oldest checked_at
+            cached['checked_at'] = time.time()
+        return cached
+    
+    # Built outside the lock; two requests for the same window may both build it, and the later one is kept
+    cached = {"fingerprint": fingerprint, "checked_at": time.time(), **build(iter_row_pages(pages))}
+    with _window_cache_lock:
+        cache[key] = cached
+        while len(cache) > max_entries:
+            cache.pop(min(cache, key=lambda entry: cache[entry]['checked_at']), None)
+    return cached
 
 
-def process_data(data):
-    observations = []
-    for obs in data:
-        photo_url = ""
-        if "photos" in obs and obs["photos"]:
-            photo_url = obs["photos"][0]['url'].replace('square', 'medium')
-        
-        observation = {
-            "id": obs["id"],
-            "observed_on": obs.get("observed_on", ""),
-            "latitude": obs.get("location", "").split(",")[0],
-            "longitude": obs.get("location", "").split(",")[-1],
-            "user_login": obs.get("user", {}).get("login", ""),
-            "created_at": obs.get("created_at", ""),
-            "name": obs.get("taxon", {}).get("name", ""),
-            "preferred_common_name": obs.get("taxon", {}).get("preferred_common_name", "").title(),
-            "native": obs.get("taxon", {}).get("native", ""),
-            "photo_url": photo_url,
-        }
-        observations.append(observation)
+def summarize_observations(row_pages):
+    # Aggregate with pandas over three typed columns; the rows themselves are not kept
+    pd = lazy_import('pandas')
+    observed_on, names, common_names = [], [], []
+    for page in row_pages:
+        if page:
+            columns = list(zip(*page))
+            observed_on.extend(columns[1])
+            names.extend(columns[6])
+            common_names.extend(columns[7])
+    
+    frame = pd.DataFrame({
+        "observed_on": pd.to_datetime(pd.Series(observed_on, dtype=object), format='%Y-%m-%d', errors='coerce'),
+        "name": pd.Series(names, dtype='category'),
+        "common_name": pd.Series(common_names, dtype='category'),
+    })
+    frame = frame[frame['observed_on'].notna()]
+    
+    per_day = frame.groupby('observed_on').size()
+    week_start = frame['observed_on'] - pd.to_timedelta(frame['observed_on'].dt.weekday, unit='D')  # Mondays
+    per_week = frame.groupby(week_start).size()
+    species = (
+        frame[frame['name'] != '']
+        .groupby('name', observed=True)
+        .agg(count=('observed_on', 'size'), first_seen=('observed_on', 'min'),
+             last_seen=('observed_on', 'max'), common_name=('common_name', 'first'))
+        .reset_index()
+        .sort_values(['count', 'name'], ascending=[False, True])
+    )
+    
+    def by_date(counts):
+        return dict(zip(counts.index.strftime('%Y-%m-%d'), counts.tolist()))
+    
+    return {
+        "total_observations": len(frame),
+        "species_count": len(species),
+        "first_sighting": frame['observed_on'].min().strftime('%Y-%m-%d') if len(frame) else None,
+        "last_sighting": frame['observed_on'].max().strftime('%Y-%m-%d') if len(frame) else None,
+        "species": [
+            {
+                "name": name,
+                "common_name": common_name,
+                "count": count,
+                "first_seen": first_seen.strftime('%Y-%m-%d'),
+                "last_seen": last_seen.strftime('%Y-%m-%d'),
+            }
+            for name, count, first_seen, last_seen, common_name in zip(
+                species['name'].tolist(), species['count'].tolist(), species['first_seen'],
+                species['last_seen'], species['common_name'].tolist(),
+            )
+        ],
+        "per_day": by_date(per_day),
+        "per_week": by_date(per_week),
+    }
 
-    df = pd.DataFrame(observations)
-    return df
 
-def upload_log_to_s3():
+def get_observation_tile(endpoint, query_params, if_none_match=None):
+    # /tiles/{z}/{x}/{y}: per-cell counts and top taxa for one map tile
+    match = re.fullmatch(r'/tiles/(\d+)/(\d+)/(\d+)', endpoint)
+    if not match:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": "Tiles are requested as /tiles/{z}/{x}/{y}."})
+        }
+    z, x, y = (int(part) for part in match.groups())
+    if z > TILE_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": f"No tile {z}/{x}/{y}. Zoom must be at most {TILE_MAX_ZOOM} and x and y below 2^zoom."})
+        }
+    
+    start_date, end_date, error_response = parse_date_range(query_params)
+    if error_response:
+        return error_response
+    
     try:
-        s3 = boto3.client('s3')
-        bucket_name = os.environ.get('S3_BUCKET_NAME')
-        log_prefix = 'logs/execution_log.log'
-        
-        # Read existing log data from S3
-        existing_log_data = ""
-        try:
-            obj = s3.get_object(Bucket=bucket_name, Key=log_prefix)
-            existing_log_data = obj['Body'].read().decode('utf-8')
-        except s3.exceptions.NoSuchKey:
-            # If the log file doesn't exist yet, ignore the error
-            pass
-        
-        # Append new log data to existing log data
-        with open(log_file, 'r') as new_log_file:
-            new_log_data = new_log_file.read()
-        
-        combined_log_data = existing_log_data + new_log_data
-        
-        # Upload combined log data to S3
-        s3.put_object(Bucket=bucket_name, Key=log_prefix, Body=combined_log_data.encode('utf-8'))
-        
-        logger.info("Log file uploaded to S3 successfully")
-    except Exception as e:
-        logger.error(f"Error uploading log file to S3: {str(e)}")
+        cached = cached_for_window(_tile_cache, TILE_CACHE_ENTRIES, TILE_CACHE_TTL, start_date, end_date, tile_columns)
+    except UpstreamError as e:
+        return {
+            "statusCode": e.status_code,
+            "body": e.body
+        }
+    
+    # Concurrent requests may bin the same zoom level or render the same tile; the first result is kept
+    tiles = cached['zooms'].get(z)
+    if tiles is None:
+        with timed('tiles'):
+            tiles = bin_tiles(cached, z)
+        with _window_cache_lock:
+            tiles = cached['zooms'].setdefault(z, tiles)
+    with _window_cache_lock:
+        rendered = cached['bodies'].get((z, x, y))
+        if rendered is not None:
+            cached['bodies'].move_to_end((z, x, y))
+    if rendered is None:
+        cells = tiles.get((x, y), [])
+        body = json.dumps({
+            "z": z, "x": x, "y": y,
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat(),
+            "grid": TILE_GRID_CELLS,
+            "total": sum(cell['count'] for cell in cells),
+            "cells": cells,
+        })
+        with _window_cache_lock:
+            rendered = cached['bodies'].setdefault((z, x, y), (body, hashlib.blake2b(body.encode('utf-8'), digest_size=16).hexdigest()))
+            while len(cached['bodies']) > TILE_BODY_ENTRIES:
+                cached['bodies'].popitem(last=False)
+    body, etag = rendered
+    
+    matched = etag_matches(if_none_match, etag)
+    if matched:
+        return not_modified(matched)
+    return {
+        "statusCode": 200,
+        "headers": {
+            "Content-Type": "application/json",
+            "ETag": representation_etag(etag),
+        },
+        "body": body
+    }
+
+
+def tile_columns(row_pages):
+    # Observation positions projected once into Web Mercator (0..1 across the world), plus taxon codes.
+    # Every zoom level is binned from these arrays.
+    np = lazy_import('numpy')
+    pd = lazy_import('pandas')
+    latitudes, longitudes, names = [], [], []
+    for page in row_pages:
+        if page:
+            columns = list(zip(*page))
+            latitudes.extend(columns[2])
+            longitudes.extend(columns[3])
+            names.extend(columns[6])
+    
+    latitude = pd.to_numeric(pd.Series(latitudes, dtype=object), errors='coerce').to_numpy(dtype=float)
+    longitude = pd.to_numeric(pd.Series(longitudes, dtype=object), errors='coerce').to_numpy(dtype=float)
+    located = ~(np.isnan(latitude) | np.isnan(longitude))
+    taxa = pd.Categorical(pd.Series(names, dtype=object)[located])
+    
+    latitude = np.radians(np.clip(latitude[located], -85.05112878, 85.05112878))  # Mercator's limits
+    return {
+        "mercator_x": (longitude[located] + 180) / 360,
+        "mercator_y": (1 - np.log(np.tan(latitude) + 1 / np.cos(latitude)) / np.pi) / 2,
+        "taxon_codes": taxa.codes,
+        "taxon_names": list(taxa.categories),
+        "zooms": {},  # zoom -> {(x, y): cells}
+        "bodies": OrderedDict(),  # (z, x, y) -> (body, etag), least recently used first
+    }
+
+
+def bin_tiles(columns, z):
+    # Bin every observation into its grid cell at zoom z in one pass, then group cells by tile
+    np = lazy_import('numpy')
+    pd = lazy_import('pandas')
+    cells_across = (2 ** z) * TILE_GRID_CELLS
+    cell_x = np.clip((columns['mercator_x'] * cells_across).astype(np.int64), 0, cells_across - 1)
+    cell_y = np.clip((columns['mercator_y'] * cells_across).astype(np.int64), 0, cells_across - 1)
+    
+    counts = (
+        pd.DataFrame({"cell_x": cell_x, "cell_y": cell_y, "taxon": columns['taxon_codes']})
+        .groupby(['cell_x', 'cell_y', 'taxon']).size().rename('count').reset_index()
+        .sort_values(['cell_x', 'cell_y', 'count', 'taxon'], ascending=[True, True, False, True])
+    )
+    totals = counts.groupby(['cell_x', 'cell_y'])['count'].sum()
+    top = counts.groupby(['cell_x', 'cell_y']).head(TILE_TOP_TAXA)
+    
+    taxon_names = columns['taxon_names']
+    top_taxa = {}
+    for cell_x, cell_y, taxon, count in zip(top['cell_x'].tolist(), top['cell_y'].tolist(), top['taxon'].tolist(), top['count'].tolist()):
+        top_taxa.setdefault((cell_x, cell_y), []).append({"name": taxon_names[taxon] if taxon >= 0 else "", "count": count})
+    
+    tiles = {}
+    for (cell_x, cell_y), count in zip(totals.index.tolist(), totals.tolist()):
+        tile = (cell_x // TILE_GRID_CELLS, cell_y // TILE_GRID_CELLS)
+        tiles.setdefault(tile, []).append({
+            "row": cell_y % TILE_GRID_CELLS,
+            "col": cell_x % TILE_GRID_CELLS,
+            "count": count,
+            "top_taxa": top_taxa[(cell_x, cell_y)],
+        })
+    return tiles
+
+
+def warm_default_window():
+    # Scheduled warm-up: rebuild the default-window CSV response (and its gzip encoding) so dateless /data
+    # requests skip fetching and serializing. Also keeps this container's connection pools warm.
+    global _default_window
+    started = time.perf_counter()
+    response = get_observation_data({}, use_materialized=False)
+    
+    headers = response.get('headers', {})
+    if response.get('statusCode') != 200 or headers.get('Content-Type') != 'text/csv' or 'body' not in response:
+        # Upstream failed, or the window was large enough to be offloaded to S3 (presigned links expire)
+        logger.warning(f"Default window not materialized (status {response.get('statusCode')})")
+        return {"materialized": False, "status": response.get('statusCode')}
+    
+    body = response['body']
+    encoded = {}
+    if COMPRESSION_ENABLED and len(body) >= COMPRESSION_MIN_BYTES:
+        encoded['gzip'] = compress_chunks([body], 'gzip', compression_level(len(body)))
+    _default_window = {
+        "end_date": datetime.now().date(),
+        "built_at": time.time(),
+        "response": response,
+        "encoded": encoded,
+    }
+    built_ms = (time.perf_counter() - started) * 1000
+    logger.info(f"Materialized the default window: {len(body)} bytes in {built_ms:.0f} ms")
+    return {"materialized": True, "bytes": len(body), "built_ms": round(built_ms)}
+
+
+def default_window_is_current(materialized):
+    # Built for today's window and recently enough
+    return (materialized['end_date'] == datetime.now().date()
+            and time.time() - materialized['built_at'] < DEFAULT_WINDOW_MAX_AGE)
+
+
+def serve_default_window(materialized, encoding, if_none_match):
+    response = materialized['response']
+    etag = response['headers'].get('ETag', '').strip('"')
+    matched = etag_matches(if_none_match, etag) if etag else None
+    if matched:
+        return not_modified(matched)
+    
+    response = {**response, "headers": dict(response['headers'])}  # Callers add headers; keep the copy clean
+    if encoding is None or len(response['body']) < COMPRESSION_MIN_BYTES:
+        return response
+    encoded = materialized['encoded'].get(encoding)
+    if encoded is None:
+        encoded = compress_chunks([response['body']], encoding, compression_level(len(response['body'])))
+        materialized['encoded'][encoding] = encoded
+    return encoded_response(response, encoded, encoding)
+
+
+def open_observation_stream(params, start_date, end_date, stats):
+    # Start the page pipeline and pull the first page, so the expected row count is known (and any
+    # upstream error has surfaced) before the caller commits to a response shape
+    if OBSERVATION_CACHE_ENABLED:
+        pages = iter_observations_cached(params, start_date, end_date, stats)
+    else:
+        pages = iter_pages(params, stats)
+    
+    first_page = next(pages, None)
+    if first_page is None:
+        return iter(())
+    return itertools.chain([first_page], pages)
+
+
+def iter_hashed(chunks, digest):
+    for chunk in chunks:
+        digest.update(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+        yield chunk
+
+
+def offload_observation_data(chunks, stats, output_format='csv'):
+    content_type, extension = OUTPUT_FORMATS[output_format]
+    key = f"{OFFLOAD_PREFIX}{datetime.now(timezone.utc):%Y/%m/%d}/{uuid.uuid4()}.{extension}"
+    size = upload_chunks_multipart(chunks, key, content_type=content_type)
+    
+    download_url = get_s3_client().generate_presigned_url(
+        'get_object',
+        Params={
+            "Bucket": os.environ.get('S3_BUCKET_NAME'),
+            "Key": key,
+            "ResponseContentDisposition": f"attachment; filename=inaturalist_observations.{extension}",
+        },
+        ExpiresIn=OFFLOAD_URL_EXPIRY,
+    )
+    logger.info(f"Offloaded {stats['rows']} observations ({size} bytes) to s3 key {key}")
+    
+    return {
+        "statusCode": 200,
+        "headers": {
+            "Content-Type": "application/json",
+            "metadata_version": DATA_METADATA_VERSION,
+        },
+        "body": json.dumps({
+            "download_url": download_url,
+            "expires_in": OFFLOAD_URL_EXPIRY,
+            "row_count": stats['rows'],
+            "size_bytes": size,
+            "format": output_format,
+            "metadata_version": DATA_METADATA_VERSION,
+        }),
+    }
+
+
+def upload_chunks_multipart(chunks, key, content_type):
+    # Upload text or binary chunks as they are generated, holding at most one part in memory. Returns bytes written.
+    s3 = get_s3_client()
+    bucket_name = os.environ.get('S3_BUCKET_NAME')
+    upload_id = s3.create_multipart_upload(Bucket=bucket_name, Key=key, ContentType=content_type)['UploadId']
+    parts = []
+    part = io.BytesIO()
+    size = 0
+    
+    def upload_part():
+        with timed('offload'):
+            response = s3.upload_part(
+                Bucket=bucket_name, Key=key, UploadId=upload_id,
+                PartNumber=len(parts) + 1, Body=part.getvalue(),
+            )
+        parts.append({"PartNumber": len(parts) + 1, "ETag": response['ETag']})
+        part.seek(0)
+        part.truncate()
+    
+    try:
+        for chunk in chunks:
+            encoded = chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+            part.write(encoded)
+            size += len(encoded)
+            if part.tell() >= MULTIPART_PART_BYTES:
+                upload_part()
+        if part.tell() or not parts:
+            upload_part()  # The last part may be smaller than the minimum
+        s3.complete_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+        raise
+    
+    return size
+
+
+def fetch_observations(params):
+    # Pull every observation matching params from iNaturalist using the configured fetch mode
+    return [obs for page in iter_pages(params) for obs in page]
+
+
+def get_http_session():
+    global _http_session
+    with _client_lock:
+        if _http_session is not None:
+            return _http_session
+        
+        # Only connection failures are retried here, since those requests never reached iNaturalist.
+        # Throttled and failed responses and timeouts are retried by fetch_page through the upstream
+        # governor instead, so every attempt counts against the rate limit.
+        requests = lazy_import('requests')
+        HTTPAdapter = lazy_import('requests.adapters').HTTPAdapter
+        Retry = lazy_import('urllib3.util.retry').Retry
+        retry = Retry(
+            total=HTTP_MAX_RETRIES,
+            connect=HTTP_MAX_RETRIES,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=HTTP_BACKOFF_FACTOR,
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        )
+        # One pooled connection per fetch worker so parallel pages don't queue for a socket
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(FETCH_WORKERS, 1), max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.headers['User-Agent'] = 'christchurch-fungi-reportings'
+        _http_session = session
+        return _http_session
+
+
+def get_upstream_governor():
+    global _upstream_governor
+    with _client_lock:
+        if _upstream_governor is None:
+            _upstream_governor = UpstreamGovernor(
+                UPSTREAM_RATE_LIMIT, UPSTREAM_BURST, UPSTREAM_MAX_CONCURRENCY,
+                UPSTREAM_LATENCY_TARGET, UPSTREAM_RECOVERY_SUCCESSES,
+            )
+        return _upstream_governor
+
+
+def retry_after_seconds(response):
+    # Retry-After is either a number of seconds or an HTTP date
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = lazy_import('email.utils').parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def get_s3_client():
+    global _s3_client
+    with _client_lock:
+        if _s3_client is None:
+            _s3_client = lazy_import('boto3').client('s3', endpoint_url=S3_ENDPOINT_URL)
+        return _s3_client
+
+
+def fetch_page(params, page=None):
+    # Make request to iNaturalist API for a single page (page=None for keyset requests). Throttled
+    # (429, 503) and failed (500, 502, 504, timed out) attempts are retried up to HTTP_MAX_RETRIES
+    # times, each through the upstream governor.
+    page_params = {key: value for key, value in params.items() if key != 'page'}
+    if page is not None:
+        page_params['page'] = page
+    
+    requests = lazy_import('requests')
+    session = get_http_session()
+    governor = get_upstream_governor()
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        with timed('rate_limit_wait'):
+            governor.acquire()
+        started = time.monotonic()
+        response = None
+        try:
+            with timed('upstream'):
+                response = session.get(
+                    INAT_OBSERVATIONS_URL,
+                    params=page_params,
+                    timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                )
+        except requests.exceptions.Timeout:
+            logger.error("Timed out retrieving observation data")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error connecting to iNaturalist: {str(e)}")
+            raise UpstreamError(502, json.dumps({"error": "Could not reach iNaturalist."}))
+        finally:
+            governor.release(
+                response.status_code if response is not None else None,
+                time.monotonic() - started,
+                retry_after_seconds(response) if response is not None else None,
+            )
+        
+        if response is not None and response.status_code in THROTTLE_STATUSES:
+            count_metric('upstream_throttled')  # The governor holds every thread back before the next attempt
+        elif response is None or response.status_code in RETRY_STATUSES:
+            if attempt < HTTP_MAX_RETRIES:
+                count_metric('upstream_retried')
+                retry_after = retry_after_seconds(response) if response is not None else None
+                with timed('retry_wait'):
+                    time.sleep(min(HTTP_BACKOFF_FACTOR * 2 ** attempt if retry_after is None else retry_after, UPSTREAM_MAX_PAUSE))
+        else:
+            break
+    
+    if response is None:
+        raise UpstreamError(504, json.dumps({"error": "Timed out waiting for iNaturalist."}))
+    if response.status_code != 200:
+        logger.error(f"Error retrieving observation data: {response.status_code}")
+        raise UpstreamError(response.status_code, response.text)
+    
+    count_metric('pages')
+    count_metric('bytes_in', len(response.content))
+    with timed('decode'):
+        return decode_page(response.content)
+
+
+def project_observation(obs):
+    # Keep only the fields observation_row reads, in the same shape, so the rest of the payload can be freed
+    projected = {key: obs[key] for key in OBSERVATION_FIELDS if key in obs}
+    
+    if 'user' in obs:
+        projected['user'] = {'login': obs['user']['login']} if 'login' in obs['user'] else {}
+    if 'taxon' in obs:
+        projected['taxon'] = {key: obs['taxon'][key] for key in TAXON_FIELDS if key in obs['taxon']}
+    if obs.get('photos'):
+        projected['photos'] = [{'url': obs['photos'][0]['url']}]
+    
+    return projected
+
+
+def decode_page(content):
+    # Parse the page body exactly once and project each observation as soon as it is decoded
+    page = json.loads(content)
+    return {
+        "total_results": page.get('total_results', 0),
+        "results": [project_observation(obs) for obs in page.get('results', [])],
+    }
+
+
+def iter_in_order(executor, calls, window):
+    # Run (function, *args) calls on executor with at most `window` in flight, yielding results in
+    # submission order. Bounding the look-ahead bounds how many fetched pages sit in memory at once.
+    pending = deque()
+    try:
+        for call in calls:
+            pending.append(executor.submit(with_context(call[0]), *call[1:]))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Reached on errors and when the consumer stops early; don't fetch pages nobody will read
+        for future in pending:
+            future.cancel()
+
+
+def iter_pages(params, stats=None):
+    # Yield lists of decoded observations page by page using the configured fetch mode.
+    # stats['expected_rows'] is filled in as soon as the total is known.
+    if FETCH_MODE == 'sequential':
+        return iter_pages_sequential(params, stats)
+    elif FETCH_MODE == 'keyset':
+        return iter_pages_keyset(params, stats=stats)
+    elif FETCH_MODE == 'sharded':
+        return iter_pages_sharded(params, stats)
+    elif FETCH_MODE == 'async':
+        return iter_pages_async(params, stats)
+    else:
+        return iter_pages_concurrent(params, stats)
+
+
+def iter_pages_sequential(params, stats=None):
+    page = params.get('page', 1)
+    fetched = 0
+    
+    # Continue making requests until all pages are fetched
+    while True:
+        page_data = fetch_page(params, page)
+        results = page_data.get('results', [])
+        if stats is not None and page == params.get('page', 1):
+            stats['expected_rows'] = page_data.get('total_results', 0)
+        fetched += len(results)
+        yield results
+        
+        # Check if there is more than one page
+        if results and page_data.get('total_results', 0) > fetched:
+            page += 1  # Move to the next page
+        else:
+            break  # No more pages, break the loop
+
+
+def iter_pages_concurrent(params, stats=None):
+    # The first page tells us how many results there are, so the remaining pages can be planned up front
+    first_page = fetch_page(params, 1)
+    total_results = first_page.get('total_results', 0)
+    total_pages = math.ceil(total_results / params['per_page'])
+    
+    if total_results > MAX_PAGED_RESULTS:
+        # Deep pages are rejected upstream, so walk the whole range by id instead
+        logger.info(f"{total_results} results exceeds the page depth limit, switching to keyset pagination")
+        yield from iter_pages_keyset(params, stats=stats)
+        return
+    
+    if stats is not None:
+        stats['expected_rows'] = total_results
+    yield first_page.get('results', [])
+    del first_page
+    
+    if total_pages <= 1:
+        return
+    
+    logger.info(f"Fetching {total_pages - 1} remaining pages with up to {FETCH_WORKERS} workers")
+    
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, total_pages - 1)) as executor:
+        # Yield in page order so the first failing page (by page number) decides the status code
+        calls = ((fetch_page, params, page) for page in range(2, total_pages + 1))
+        for page_data in iter_in_order(executor, calls, 2 * FETCH_WORKERS):
+            yield page_data.get('results', [])
+
+
+def iter_pages_keyset(params, id_above=None, stats=None):
+    # Walk the result set by observation id (newest first) using id_below as the cursor.
+    # Each request is a fresh index seek, so latency doesn't grow with depth and
+    # observations created mid-walk can't shift rows between pages.
+    keyset_params = {**params, "order_by": "id", "order": "desc"}
+    if id_above is not None:
+        keyset_params['id_above'] = id_above
+    
+    while True:
+        page_data = fetch_page(keyset_params)
+        results = page_data.get('results', [])
+        if stats is not None and 'id_below' not in keyset_params:
+            stats['expected_rows'] = page_data.get('total_results', 0)
+        yield results
+        
+        if len(results) < params['per_page']:
+            break  # A short page means there is nothing below the cursor
+        keyset_params['id_below'] = results[-1]['id']
+
+
+def count_results(params, start_date, end_date):
+    # per_page=0 returns only total_results, which makes it a cheap probe for a date window
+    window_params = {**params, "d1": start_date.isoformat(), "d2": end_date.isoformat(), "per_page": 0}
+    return fetch_page(window_params).get('total_results', 0)
+
+
+def plan_shards(params, executor):
+    # Split d1..d2 in half until every window is under SHARD_TARGET_RESULTS (or a single day).
+    # Each level of the split is probed in parallel.
+    pending = [(date.fromisoformat(params['d1']), date.fromisoformat(params['d2']))]
+    shards = []
+    
+    while pending:
+        futures = [executor.submit(with_context(count_results), params, *window) for window in pending]
+        counts = [future.result() for future in futures]
+        next_pending = []
+        for (start_date, end_date), count in zip(pending, counts):
+            if count == 0:
+                continue  # Nothing observed in this window
+            if count <= SHARD_TARGET_RESULTS or start_date == end_date:
+                shards.append((start_date, end_date, count))
+            else:
+                midpoint = start_date + (end_date - start_date) // 2
+                next_pending.append((start_date, midpoint))
+                next_pending.append((midpoint + timedelta(days=1), end_date))
+        pending = next_pending
+    
+    # Newest window first to match the descending order of the other modes
+    return sorted(shards, reverse=True)
+
+
+def fetch_shard(params, start_date, end_date, count):
+    # Pages of one date window (a single day can still be too deep for page numbers)
+    shard_params = {**params, "d1": start_date.isoformat(), "d2": end_date.isoformat()}
+    if count > MAX_PAGED_RESULTS:
+        return iter_pages_keyset(shard_params)
+    return iter_pages_sequential(shard_params)
+
+
+def pump_shard(pages, shard_queue, stop):
+    # Worker side of iter_pages_sharded: move a shard's pages onto its queue, then None to mark the
+    # end (or the exception that ended it). Gives up once stop is set.
+    def put(item):
+        while not stop.is_set():
+            try:
+                shard_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass  # The consumer is still on an earlier shard
+        return False
+    
+    try:
+        for page in pages:
+            if not put(page):
+                return
+        put(None)
+    except Exception as e:
+        put(e)  # Raised in the consumer, so UpstreamError still sets the status code
+
+
+def iter_pages_sharded(params, stats=None):
+    # Up to FETCH_WORKERS shards are fetched at once, each a page at a time into a queue of
+    # SHARD_QUEUE_PAGES, and read out in shard order. Memory is bounded by those queues, not shard sizes.
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        shards = plan_shards(params, executor)
+        logger.info(f"Planned {len(shards)} date shards: {[(str(d1), str(d2), count) for d1, d2, count in shards]}")
+        if stats is not None:
+            stats['expected_rows'] = sum(count for _, _, count in shards)
+        
+        stop = threading.Event()
+        
+        def start(shard):
+            shard_queue = queue.Queue(maxsize=SHARD_QUEUE_PAGES)
+            executor.submit(with_context(pump_shard), fetch_shard(params, *shard), shard_queue, stop)
+            return shard_queue
+        
+        remaining = iter(shards)
+        running = deque(start(shard) for shard in itertools.islice(remaining, FETCH_WORKERS))
+        try:
+            while running:
+                shard_queue = running.popleft()
+                while (item := shard_queue.get()) is not None:
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+                next_shard = next(remaining, None)
+                if next_shard is not None:
+                    running.append(start(next_shard))
+        finally:
+            # Reached on errors and when the consumer stops early; workers stop at their next page
+            stop.set()
+
+
+async def produce_pages(params, pages, stats=None):
+    # Fetch pages concurrently and put their results on the asyncio queue `pages` in page order.
+    # Requests run on worker threads through the shared session (and governor); pages.put waits while
+    # the consumer is behind, and at most 2 * FETCH_WORKERS pages are requested ahead of the queue.
+    asyncio = lazy_import('asyncio')
+    first_page = await asyncio.to_thread(fetch_page, params, 1)
+    total_results = first_page.get('total_results', 0)
+    
+    if total_results > MAX_PAGED_RESULTS:
+        # Deep pages are rejected upstream; keyset pages each depend on the last, so walk them in turn
+        logger.info(f"{total_results} results exceeds the page depth limit, switching to keyset pagination")
+        keyset_pages = iter_pages_keyset(params, stats=stats)
+        while (results := await asyncio.to_thread(next, keyset_pages, None)) is not None:
+            await pages.put(results)
+        return
+    
+    if stats is not None:
+        stats['expected_rows'] = total_results
+    await pages.put(first_page.get('results', []))
+    del first_page
+    
+    slots = asyncio.Semaphore(FETCH_WORKERS)
+    
+    async def fetch(page):
+        async with slots:
+            return await asyncio.to_thread(fetch_page, params, page)
+    
+    pending = deque()
+    try:
+        for page in range(2, math.ceil(total_results / params['per_page']) + 1):
+            pending.append(asyncio.ensure_future(fetch(page)))
+            if len(pending) >= 2 * FETCH_WORKERS:
+                await pages.put((await pending.popleft()).get('results', []))
+        while pending:
+            await pages.put((await pending.popleft()).get('results', []))
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def iter_pages_async(params, stats=None):
+    # Synchronous face of produce_pages. The event loop runs on its own thread, so pages keep arriving
+    # while the caller projects and serializes the ones it already has. (With the observation cache,
+    # the caller is the cache spooling pages to /tmp; serializing waits until the range is cached.)
+    asyncio = lazy_import('asyncio')
+    loop = asyncio.new_event_loop()
+    pages = asyncio.Queue(maxsize=ASYNC_QUEUE_PAGES)
+    # The producer runs in the caller's context, which asyncio.to_thread passes on to the fetch
+    # threads, so upstream timings and page counts reach this request's metrics
+    context = contextvars.copy_context()
+    
+    async def pump():
+        try:
+            await produce_pages(params, pages, stats)
+            await pages.put(None)  # End of the result set
+        except Exception as e:
+            await pages.put(e)  # Raised in the consumer, so UpstreamError still sets the status code
+    
+    async def run_in_context():
+        await asyncio.get_running_loop().create_task(pump(), context=context)
+    
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    producer = asyncio.run_coroutine_threadsafe(run_in_context(), loop)
+    try:
+        while True:
+            item = asyncio.run_coroutine_threadsafe(pages.get(), loop).result()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Reached on errors and when the consumer stops early: stop fetching, let requests already
+        # on a thread finish, then tear the loop down
+        producer.cancel()
+        asyncio.run_coroutine_threadsafe(loop.shutdown_default_executor(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
+
+
+def date_range(start_date, end_date):
+    return [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+
+
+def contiguous_runs(days):
+    # Group sorted days into (first, last) runs so each gap in the cache is fetched with one query
+    runs = []
+    for day in days:
+        if runs and day - runs[-1][1] == timedelta(days=1):
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return [tuple(run) for run in runs]
+
+
+def partition_path(day):
+    return os.path.join(OBSERVATION_CACHE_DIR, f"{day.isoformat()}.json")
+
+
+def s3_cache_enabled():
+    return S3_CACHE_ENABLED and bool(os.environ.get('S3_BUCKET_NAME'))
+
+
+def partition_is_stable(day, today):
+    return (today - day).days > OBSERVATION_CACHE_STABLE_DAYS
+
+
+def partition_needs_sync(day, partition, today):
+    age = time.time() - partition['fetched_at']
+    if day >= today:
+        return True  # Today is still collecting observations
+    if partition_is_stable(day, today):
+        return age >= OBSERVATION_CACHE_SYNC_INTERVAL
+    return age >= OBSERVATION_CACHE_RECENT_TTL
+
+
+def partition_needs_refetch(partition):
+    return partition.get('syncs', 0) >= OBSERVATION_CACHE_REFETCH_SYNCS
+
+
+def partition_is_fresh(day, partition, today):
+    if partition_needs_sync(day, partition, today):
+        return False
+    if not partition_is_stable(day, today) or not s3_cache_enabled():
+        return True
+    # Settled days are shared through S3, so check back with it now and then
+    if 's3_etag' not in partition:
+        return False
+    return time.time() - partition.get('checked_at', partition['fetched_at']) < S3_CACHE_REVALIDATE_TTL
+
+
+def read_partition(day):
+    try:
+        with open(partition_path(day), 'r') as partition_file:
+            return json.load(partition_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_partition(day, partition):
+    path = partition_path(day)
+    # Write to a private temporary file then rename, so readers never see a half-written partition
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(OBSERVATION_CACHE_DIR, exist_ok=True)
+        with open(temp_path, 'w') as partition_file:
+            json.dump(partition, partition_file)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not cache observations for {day}: {str(e)}")
+
+
+def s3_partition_key(day):
+    return f"{S3_CACHE_PREFIX}{day.isoformat()}.json.gz"
+
+
+def read_s3_partition(day, etag=None):
+    # Returns (status, partition) where status is 'hit', 'not_modified', 'missing' or 'error'
+    botocore_exceptions = lazy_import('botocore.exceptions')
+    request = {"Bucket": os.environ.get('S3_BUCKET_NAME'), "Key": s3_partition_key(day)}
+    if etag:
+        request['IfNoneMatch'] = etag
+    
+    try:
+        response = get_s3_client().get_object(**request)
+        partition = json.loads(gzip.decompress(response['Body'].read()))
+    except botocore_exceptions.ClientError as e:
+        error_code = e.response.get('Error', {}).get('Code')
+        if error_code in ('304', 'NotModified'):
+            return 'not_modified', None
+        if error_code in ('404', 'NoSuchKey'):
+            return 'missing', None
+        logger.warning(f"Error reading cached observations for {day} from S3: {str(e)}")
+        return 'error', None
+    except botocore_exceptions.BotoCoreError as e:
+        logger.warning(f"Error reading cached observations for {day} from S3: {str(e)}")
+        return 'error', None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Cached observations for {day} in S3 are unreadable: {str(e)}")
+        return 'error', None
+    
+    partition['s3_etag'] = response['ETag']
+    return 'hit', partition
+
+
+def write_s3_partition(day, partition):
+    # Share a partition through S3 without overwriting another container's copy: a first write only
+    # succeeds if the key doesn't exist yet, and a rewrite after a sync only if S3 still holds the copy
+    # that was synced (its ETag). If another container got there first, its copy is read back and kept
+    # instead; a later sync brings it up to date. Returns the partition to keep locally.
+    botocore_exceptions = lazy_import('botocore.exceptions')
+    body = {"fetched_at": partition['fetched_at'], "observations": partition['observations'],
+            "content_hash": partition_content_hash(partition), "syncs": partition.get('syncs', 0)}
+    condition = {"IfMatch": partition['s3_etag']} if partition.get('s3_etag') else {"IfNoneMatch": '*'}
+    try:
+        response = get_s3_client().put_object(
+            Bucket=os.environ.get('S3_BUCKET_NAME'),
+            Key=s3_partition_key(day),
+            Body=gzip.compress(json.dumps(body).encode('utf-8')),
+            ContentType='application/gzip',
+            **condition,
+        )
+    except botocore_exceptions.ClientError as e:
+        error_code = e.response.get('Error', {}).get('Code')
+        if error_code in ('412', 'PreconditionFailed', '409', 'ConditionalRequestConflict'):
+            logger.info(f"Cached observations for {day} were written to S3 by another container, using that copy")
+            status, shared = read_s3_partition(day)
+            return {**shared, "checked_at": time.time()} if status == 'hit' else partition
+        if error_code in ('404', 'NoSuchKey') and 'IfMatch' in condition:
+            # The copy that was synced has gone from S3, so this is a first write again
+            return write_s3_partition(day, {key: value for key, value in partition.items() if key != 's3_etag'})
+        logger.warning(f"Error writing cached observations for {day} to S3: {str(e)}")
+        return partition
+    except botocore_exceptions.BotoCoreError as e:
+        logger.warning(f"Error writing cached observations for {day} to S3: {str(e)}")
+        return partition
+    return {**partition, "s3_etag": response['ETag'], "checked_at": time.time()}
+
+
+def lookup_s3_partitions(days, local_partitions):
+    # Fetch settled days from S3 in parallel, saving each to /tmp as it arrives. Returns the headers of
+    # the partitions found and the days S3 doesn't have yet, which this container is responsible for
+    # writing (once).
+    found = {}
+    absent = []
+    
+    def lookup(day):
+        local = local_partitions.get(day)
+        status, partition = read_s3_partition(day, local.get('s3_etag') if local else None)
+        if status == 'not_modified':
+            partition = read_partition(day)  # Unchanged; only the time it was last checked moves on
+        if partition is None:
+            return status, None
+        partition['checked_at'] = time.time()
+        write_partition(day, partition)
+        return status, partition_header(partition)
+    
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        for day, (status, header) in zip(days, executor.map(lookup, days)):
+            if header is not None:
+                found[day] = header
+            elif status == 'missing':
+                absent.append(day)
+            elif day in local_partitions:
+                found[day] = local_partitions[day]  # S3 unavailable, keep serving the local copy
+    
+    return found, absent
+
+
+def sync_partitions(params, days, stale):
+    # Bring stored partitions for a contiguous run of days up to date with only the observations
+    # updated since the oldest of them was fetched. Every quality grade and iconic taxon is requested,
+    # so observations that have lost research grade or been re-identified out of Fungi can be dropped.
+    # Each day is read, merged and written back in turn.
+    # Returns {day: (header, changed)}; the header is None for a day that has gone from /tmp meanwhile.
+    since = min(stale[day]['fetched_at'] for day in days) - SYNC_OVERLAP_SECONDS
+    synced_at = time.time()
+    sync_params = {key: value for key, value in params.items() if key not in ('quality_grade', 'iconic_taxa')}
+    changes = fetch_observations({
+        **sync_params,
+        "d1": days[0].isoformat(),
+        "d2": days[-1].isoformat(),
+        "updated_since": datetime.fromtimestamp(since, tz=timezone.utc).isoformat(),
+    })
+    
+    # Every changed observation is taken out of the day it was stored under, then put back under its
+    # (possibly new) day if it is still a research grade fungus
+    updated_ids = {obs['id'] for obs in changes}
+    placed = {day: [] for day in days}
+    for obs in changes:
+        if obs.get('quality_grade') != 'research' or (obs.get('taxon') or {}).get('iconic_taxon_name') != params.get('iconic_taxa'):
+            continue
+        try:
+            new_day = date.fromisoformat(obs.get('observed_on') or '')
+        except ValueError:
+            continue
+        if new_day in placed:
+            placed[new_day].append(obs)
+    
+    synced = {}
+    for day in days:
+        partition = read_partition(day)
+        if partition is None:
+            synced[day] = (None, False)
+            continue
+        kept = [obs for obs in partition['observations'] if obs['id'] not in updated_ids]
+        changed = len(kept) < len(partition['observations']) or bool(placed[day])
+        if changed:
+            # Keep the newest-first order a full fetch would give
+            observations = sorted(kept + placed[day], key=lambda obs: obs.get('created_at') or '', reverse=True)
+            partition = {**partition, "observations": observations, "content_hash": observations_hash(observations)}
+        partition['fetched_at'] = synced_at
+        partition['syncs'] = partition.get('syncs', 0) + 1
+        write_partition(day, partition)
+        synced[day] = (partition_header(partition), changed)
+    
+    logger.info(f"Incremental sync of {days[0]}..{days[-1]}: {len(changes)} updated observations, "
+                f"{sum(changed for _, changed in synced.values())} days changed")
+    return synced
+
+
+def observations_hash(observations):
+    return hashlib.blake2b(json.dumps(observations, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def partition_content_hash(partition):
+    # Partitions cached before content hashes were recorded are hashed on demand
+    return partition.get('content_hash') or observations_hash(partition['observations'])
+
+
+def split_by_day(observations, days):
+    partitions = {day: [] for day in days}
+    for obs in observations:
+        try:
+            partitions[date.fromisoformat(obs.get('observed_on') or '')].append(obs)
+        except (ValueError, KeyError):
+            logger.warning(f"Observation {obs.get('id')} has observed_on {obs.get('observed_on')!r} outside the requested days")
+    return partitions
+
+
+def partition_header(partition):
+    # What is kept in memory about a partition while a range is prepared; the observations stay on
+    # disk until their day is served
+    header = {key: value for key, value in partition.items() if key != 'observations'}
+    header['rows'] = len(partition['observations'])
+    header['content_hash'] = partition_content_hash(partition)
+    return header
+
+
+def spool_path(day):
+    return f"{partition_path(day)}.{os.getpid()}.{threading.get_ident()}.spool"
+
+
+def spool_observations(day, observations, held):
+    # Append observations to the day's spool file. If the spool can't be written, the day's observations
+    # from here on are held in memory instead.
+    if day not in held:
+        path = spool_path(day)
+        try:
+            os.makedirs(OBSERVATION_CACHE_DIR, exist_ok=True)
+            with open(path, 'ab') as spool:
+                end = spool.tell()
+                try:
+                    spool.write(''.join(json.dumps(obs) + '\n' for obs in observations).encode('utf-8'))
+                    spool.flush()
+                except OSError:
+                    spool.truncate(end)  # Don't leave half a page behind to be read twice
+                    raise
+            return
+        except OSError as e:
+            logger.warning(f"Could not spool observations for {day}, holding them in memory: {str(e)}")
+            held[day] = []
+    held[day].extend(observations)
+
+
+def fetch_partitions(params, days, previous=None):
+    # Fetch a contiguous run of days in full and write one partition per observed_on day. Each page is
+    # split by day as it arrives and appended to a spool file per day, so memory holds a page rather
+    # than the run; each partition is then written from its spool. previous holds the headers of days
+    # being fetched again, whose S3 ETag is kept so a changed day is rewritten conditionally.
+    # Returns {day: header}.
+    previous = previous or {}
+    fetched_at = time.time()
+    spooled = set()
+    held = {}
+    try:
+        for page in iter_pages({**params, "d1": days[0].isoformat(), "d2": days[-1].isoformat()}):
+            for day, observations in split_by_day(page, days).items():
+                if observations:
+                    spool_observations(day, observations, held)
+                    spooled.add(day)
+        
+        headers = {}
+        for day in days:
+            observations = []
+            if day in spooled and os.path.exists(spool_path(day)):
+                with open(spool_path(day), 'rb') as spool:
+                    observations = [json.loads(line) for line in spool]
+            observations += held.pop(day, [])
+            partition = {"fetched_at": fetched_at, "observations": observations,
+                         "content_hash": observations_hash(observations)}
+            if previous.get(day, {}).get('s3_etag'):
+                partition['s3_etag'] = previous[day]['s3_etag']
+            write_partition(day, partition)
+            headers[day] = partition_header(partition)
+        return headers
+    finally:
+        for day in spooled:
+            with contextlib.suppress(OSError):
+                os.remove(spool_path(day))
+
+
+def share_partition(day):
+    # Write this container's copy of a settled day to S3, and note the S3 ETag on the local copy
+    partition = read_partition(day)
+    if partition is None:
+        return None
+    partition = write_s3_partition(day, partition)
+    write_partition(day, partition)
+    return partition_header(partition)
+
+
+def iter_observations_cached(params, start_date, end_date, stats=None):
+    # Bring every day in the range up to date in /tmp, then yield the days newest first, one list per
+    # day read back from disk. Only partition headers are kept in memory meanwhile, so a cold range
+    # costs a page of the fetch (or the day being merged) rather than the whole range.
+    today = datetime.now().date()
+    days = date_range(start_date, end_date)
+    current = {}  # Headers of partitions that are up to date in /tmp
+    stored = {}  # Headers of copies that may need an incremental sync
+    s3_days = []
+    
+    # Tier 1: this container's /tmp
+    for day in days:
+        cached = read_partition(day)
+        if cached is not None and partition_is_fresh(day, cached, today):
+            current[day] = partition_header(cached)
+            continue
+        if cached is not None:
+            stored[day] = partition_header(cached)
+        if s3_cache_enabled() and partition_is_stable(day, today):
+            s3_days.append(day)
+    
+    # Tier 2: partitions shared between containers in S3
+    s3_writes = set()
+    if s3_days:
+        with timed('s3_cache'):
+            found, absent = lookup_s3_partitions(s3_days, stored)
+        stored.update(found)
+        s3_writes.update(absent)  # This container shares these days once it has them
+        logger.info(f"S3 observation cache: {len(found)} of {len(s3_days)} days found")
+    
+    stale = {}
+    refetch = {}
+    for day, header in stored.items():
+        if not partition_needs_sync(day, header, today):
+            current[day] = header
+        elif partition_needs_refetch(header):
+            refetch[day] = header  # Synced often enough; fetch it in full to catch deleted observations
+        else:
+            stale[day] = header
+    
+    missing_days = [day for day in days if day not in current and day not in stale]
+    logger.info(f"Observation cache: {len(current)} of {len(days)} days current, syncing {len(stale)}, "
+                f"fetching {len(missing_days)} ({len(refetch)} of them again in full)")
+    count_metric('cache_days_current', len(current))
+    count_metric('cache_days_missed', len(stale) + len(missing_days))
+    
+    # Stored days only need what changed since they were fetched
+    for run_start, run_end in contiguous_runs(sorted(stale)):
+        for day, (header, changed) in sync_partitions(params, date_range(run_start, run_end), stale).items():
+            if header is None:
+                missing_days.append(day)  # Gone from /tmp mid-sync, so fetched in full below
+                continue
+            current[day] = header
+            if changed and s3_cache_enabled() and partition_is_stable(day, today):
+                s3_writes.add(day)
+    
+    # Fetch only the gaps, streamed into one partition per observed_on day
+    for run_start, run_end in contiguous_runs(sorted(missing_days)):
+        for day, header in fetch_partitions(params, date_range(run_start, run_end), refetch).items():
+            current[day] = header
+            changed = day in refetch and header['content_hash'] != refetch[day]['content_hash']
+            if changed and s3_cache_enabled() and partition_is_stable(day, today):
+                s3_writes.add(day)
+    
+    if s3_writes:
+        s3_write_days = sorted(s3_writes)
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            for day, header in zip(s3_write_days, executor.map(share_partition, s3_write_days)):
+                if header is not None:
+                    current[day] = header
+    
+    if stats is not None:
+        stats['expected_rows'] = sum(current[day]['rows'] for day in days)
+        # Identifies exactly what is about to be served, for the /data ETag and the observation store
+        content_hashes = {day: current[day]['content_hash'] for day in days}
+        fingerprint = hashlib.blake2b(json.dumps(params, sort_keys=True).encode('utf-8'), digest_size=16)
+        for day in days:
+            fingerprint.update(f"{day}:{content_hashes[day]};".encode('utf-8'))
+        stats['fingerprint'] = fingerprint.hexdigest()
+        stats['content_hashes'] = content_hashes
+    
+    # Read the partitions back newest day first, so only the day being served is in memory
+    for day in reversed(days):
+        partition = read_partition(day)
+        if partition is None:
+            # Evicted from /tmp since it was checked (or never written); fetch the day again rather than fail
+            partition = {"observations": fetch_observations({**params, "d1": day.isoformat(), "d2": day.isoformat()})}
+        yield partition['observations']
+
+
+def observation_row(obs):
+    # Flatten one decoded observation into the CSV_COLUMNS order
+    photo_url = ""
+    if "photos" in obs and obs["photos"]:
+        photo_url = obs["photos"][0]['url'].replace('square', 'medium')
+    
+    location = obs.get("location", "")
+    taxon = obs.get("taxon", {})
+    return (
+        obs["id"],
+        obs.get("observed_on", ""),
+        location.split(",")[0],
+        location.split(",")[-1],
+        obs.get("user", {}).get("login", ""),
+        obs.get("created_at", ""),
+        taxon.get("name", ""),
+        taxon.get("preferred_common_name", "").title(),
+        taxon.get("native", ""),
+        photo_url,
+    )
+
+
+def iter_row_pages(pages):
+    # Flatten pages of decoded observations into pages of CSV_COLUMNS rows for the serializers
+    for page in pages:
+        with timed('serialize'):
+            rows = [observation_row(obs) for obs in page]
+        yield rows
+
+
+def iter_csv_pages(pages, stats=None):
+    # Same columns, quoting (QUOTE_MINIMAL) and line endings as DataFrame.to_csv(index=False),
+    # without building a DataFrame first. Yields the header, then one CSV chunk per page of rows.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(CSV_COLUMNS)
+    yield buffer.getvalue()
+    
+    for page in pages:
+        with timed('serialize'):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(page)
+        count_metric('rows', len(page))
+        if stats is not None:
+            stats['rows'] = stats.get('rows', 0) + len(page)
+        yield buffer.getvalue()
+
+
+def iter_output_chunks(output_format, pages, stats=None):
+    # pages holds CSV_COLUMNS rows (see iter_row_pages)
+    if output_format == 'ndjson':
+        return iter_ndjson_pages(pages, stats)
+    if output_format == 'parquet':
+        return iter_parquet_chunks(pages, stats)
+    return iter_csv_pages(pages, stats)
+
+
+def load_metadata(version):
+    # Read one version of the metadata JSON (e.g. "1.0.0") from S3
+    return read_metadata_object(metadata_key(parse_metadata_version(version)))
+
+
+def get_column_types():
+    # Declared type of each CSV_COLUMNS entry, taken from the metadata the data is published against.
+    # If the metadata can't be read, the defaults are used for METADATA_CACHE_TTL seconds before trying again.
+    global _column_types, _column_types_expire_at
+    if _column_types is not None and (_column_types_expire_at is None or time.time() < _column_types_expire_at):
+        return _column_types
+    try:
+        metadata = load_metadata(DATA_METADATA_VERSION)['metadata']
+        declared = {field['name']: field['type']
+                    for section in ('attributes', 'dimensions', 'code_lists')
+                    for field in metadata.get(section, [])}
+    except Exception as e:
+        logger.warning(f"Could not read column types from metadata {DATA_METADATA_VERSION}, using defaults: {str(e)}")
+        _column_types = [DEFAULT_COLUMN_TYPES.get(column, 'Text') for column in CSV_COLUMNS]
+        _column_types_expire_at = time.time() + METADATA_CACHE_TTL
+        return _column_types
+    _column_types = [declared.get(column, DEFAULT_COLUMN_TYPES.get(column, 'Text')) for column in CSV_COLUMNS]
+    _column_types_expire_at = None
+    return _column_types
+
+
+def to_text(value):
+    return None if value is None else str(value)
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_boolean(value):
+    if isinstance(value, bool):
+        return value
+    return {"true": True, "false": False}.get(str(value).lower())
+
+
+def to_date(value):
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_timestamp(value):
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+
+
+# Metadata type name -> converter from the flattened row value
+TYPE_CONVERTERS = {
+    "Text": to_text,
+    "Text (URL)": to_text,
+    "Date": to_date,
+    "Date and Time": to_timestamp,
+    "Float": to_float,
+    "Boolean": to_boolean,
+}
+
+
+def get_row_converters():
+    return [TYPE_CONVERTERS.get(column_type, to_text) for column_type in get_column_types()]
+
+
+def json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def iter_ndjson_pages(pages, stats=None):
+    # One JSON object per line with values typed by the metadata (dates as ISO strings)
+    converters = get_row_converters()
+    for page in pages:
+        lines = []
+        with timed('serialize'):
+            for row in page:
+                typed = {column: convert(value) for column, convert, value in zip(CSV_COLUMNS, converters, row)}
+                lines.append(json.dumps(typed, default=json_default))
+        count_metric('rows', len(page))
+        if stats is not None:
+            stats['rows'] = stats.get('rows', 0) + len(page)
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+
+def arrow_type(pa, column_type):
+    return {
+        "Date": pa.date32(),
+        "Date and Time": pa.timestamp('us', tz='UTC'),
+        "Float": pa.float64(),
+        "Boolean": pa.bool_(),
+    }.get(column_type, pa.string())
+
+
+def iter_parquet_chunks(pages, stats=None):
+    # pyarrow comes with the AWSSDKPandas layer; it is only imported when Parquet is asked for
+    pa = lazy_import('pyarrow')
+    pq = lazy_import('pyarrow.parquet')
+    column_types = get_column_types()
+    converters = get_row_converters()
+    schema = pa.schema([(column, arrow_type(pa, column_type)) for column, column_type in zip(CSV_COLUMNS, column_types)])
+    
+    # Each row group is handed on as soon as it is written, so only one is held in memory
+    sink = ChunkSink()
+    columns = [[] for _ in CSV_COLUMNS]
+    
+    def write_row_group():
+        writer.write_table(pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+        for values in columns:
+            values.clear()
+    
+    with pq.ParquetWriter(sink, schema) as writer:
+        for page in pages:
+            with timed('serialize'):
+                for row in page:
+                    for values, convert, value in zip(columns, converters, row):
+                        values.append(convert(value))
+            count_metric('rows', len(page))
+            if stats is not None:
+                stats['rows'] = stats.get('rows', 0) + len(page)
+            if len(columns[0]) >= PARQUET_ROW_GROUP_ROWS:
+                with timed('serialize'):
+                    write_row_group()
+                yield sink.drain()
+        if columns[0]:
+            with timed('serialize'):
+                write_row_group()
+    
+    yield sink.drain()  # The last row group and the footer
+
+
+def cut_log_segment(request_id):
+    # Move everything logged since the last cut out of the live log file into a pending segment file
+    if file_handler is None:
+        return None
+    
+    file_handler.acquire()
+    try:
+        file_handler.flush()
+        with open(log_file, 'r+') as live_log:
+            log_data = live_log.read()
+            live_log.seek(0)
+            live_log.truncate()
+    finally:
+        file_handler.release()
+    
+    if not log_data:
+        return None
+    
+    now = datetime.now(timezone.utc)
+    key = f"{LOG_PREFIX}segments/{now:%Y/%m/%d/%H}/{now:%Y%m%dT%H%M%S%f}Z-{request_id}.log"
+    os.makedirs(LOG_SEGMENT_DIR, exist_ok=True)
+    path = os.path.join(LOG_SEGMENT_DIR, key.replace('/', '__'))
+    with open(path, 'w') as segment:
+        segment.write(log_data)
+    return path
+
+
+def ship_pending_log_segments():
+    s3 = get_s3_client()
+    bucket_name = os.environ.get('S3_BUCKET_NAME')
+    
+    for name in sorted(os.listdir(LOG_SEGMENT_DIR)):
+        path = os.path.join(LOG_SEGMENT_DIR, name)
+        try:
+            with open(path, 'rb') as segment:
+                s3.put_object(Bucket=bucket_name, Key=name.replace('__', '/'), Body=segment.read())
+            os.remove(path)
+        except Exception as e:
+            # Left in place; the next invocation tries again
+            logger.error(f"Error uploading log segment {name} to S3: {str(e)}")
+            return
+    
+    logger.info("Log segments uploaded to S3 successfully")
+
+
+def upload_log_to_s3(request_id=None):
+    # Ship only this invocation's lines as a new object, so cost doesn't grow with history and
+    # concurrent containers never overwrite each other
+    global _log_shipper
+    try:
+        cut_log_segment(request_id or uuid.uuid4().hex)
+    except OSError as e:
+        logger.error(f"Error cutting log segment: {str(e)}")
+        return
+    
+    if LOG_SHIPPING == 'sync':
+        ship_pending_log_segments()
+        return
+    # Runs after the response goes out (finishing on a later thaw if the container is frozen first).
+    # If a shipper is still busy, this segment waits for the next invocation. Locked so concurrent
+    # requests under server.py can't start two shippers uploading the same segments.
+    with _client_lock:
+        if _log_shipper is None or not _log_shipper.is_alive():
+            _log_shipper = threading.Thread(target=ship_pending_log_segments, daemon=True)
+            _log_shipper.start()
+
+
+def flush_logs():
+    # Ship everything not yet in S3 before the process exits, waiting for a background upload in progress
+    if _log_shipper is not None:
+        _log_shipper.join()
+    try:
+        cut_log_segment(f"shutdown-{uuid.uuid4().hex}")
+    except OSError as e:
+        logger.error(f"Error cutting log segment: {str(e)}")
+    if os.path.isdir(LOG_SEGMENT_DIR) and os.listdir(LOG_SEGMENT_DIR):
+        ship_pending_log_segments()
+
+
+def compact_log_segments(day):
+    # Offline: merge one UTC day's segments (in time order) into logs/compacted/YYYY/MM/DD.log and
+    # delete them. Returns the number of segments merged.
+    s3 = get_s3_client()
+    bucket_name = os.environ.get('S3_BUCKET_NAME')
+    paginator = s3.get_paginator('list_objects_v2')
+    segment_keys = sorted(
+        obj['Key']
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{LOG_PREFIX}segments/{day:%Y/%m/%d}/")
+        for obj in page.get('Contents', [])
+    )
+    if not segment_keys:
+        return 0
+    
+    compacted_key = f"{LOG_PREFIX}compacted/{day:%Y/%m/%d}.log"
+    parts = []
+    try:
+        parts.append(s3.get_object(Bucket=bucket_name, Key=compacted_key)['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        pass  # First compaction for this day
+    for key in segment_keys:
+        parts.append(s3.get_object(Bucket=bucket_name, Key=key)['Body'].read())
+    
+    s3.put_object(Bucket=bucket_name, Key=compacted_key, Body=b''.join(parts))
+    for start in range(0, len(segment_keys), 1000):  # delete_objects takes at most 1000 keys
+        s3.delete_objects(
+            Bucket=bucket_name,
+            Delete={"Objects": [{"Key": key} for key in segment_keys[start:start + 1000]], "Quiet": True},
+        )
+    
+    logger.info(f"Compacted {len(segment_keys)} log segments into {compacted_key}")
+    return len(segment_keys)
+
 
+import_times['lambda_function'] = (time.perf_counter() - _module_load_started) * 1000
@@ -0,0 +1,147 @@
+import os
+import time
+import uuid
+import base64
+import signal
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+import lambda_function
+
+# Runs lambda_handler as a long-lived HTTP service. Every request is handled in this one process, so the
+# observation and metadata caches, the HTTP session and the upstream rate limit are shared between them.
+SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.environ.get('PORT', 8080))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 16))  # Requests handled at once; the rest wait for a worker
+SERVER_REQUEST_TIMEOUT = int(os.environ.get('SERVER_REQUEST_TIMEOUT', 300))  # Seconds, like a Lambda timeout
+SERVER_KEEPALIVE_TIMEOUT = int(os.environ.get('SERVER_KEEPALIVE_TIMEOUT', 5))  # Seconds an idle connection may hold a worker
+SERVER_SHUTDOWN_GRACE = int(os.environ.get('SERVER_SHUTDOWN_GRACE', 30))  # Seconds requests in progress get to finish on shutdown
+
+logger = logging.getLogger()
+
+
+class InvocationContext:
+    # The parts of the Lambda context object that lambda_handler uses
+    def __init__(self):
+        self.aws_request_id = uuid.uuid4().hex
+        self.deadline = time.monotonic() + SERVER_REQUEST_TIMEOUT
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self.deadline - time.monotonic()) * 1000), 0)
+
+
+class LambdaRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so clients can reuse connections
+    timeout = SERVER_KEEPALIVE_TIMEOUT  # An idle connection is closed rather than keeping its worker
+
+    def do_GET(self):
+        with self.server.active_lock:
+            self.server.active_requests += 1
+        try:
+            self.handle_invocation()
+        finally:
+            with self.server.active_lock:
+                self.server.active_requests -= 1
+
+    def handle_invocation(self):
+        # Translate the request into the API Gateway proxy event lambda_handler expects
+        url = urlsplit(self.path)
+        event = {
+            "path": url.path,
+            "httpMethod": "GET",
+            "requestContext": {"path": url.path},
+            "headers": dict(self.headers.items()),
+            "queryStringParameters": dict(parse_qsl(url.query)),
+        }
+        response = lambda_function.lambda_handler(event, InvocationContext())
+
+        body = response.get('body') or ''
+        body = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode('utf-8')
+        status = response.get('statusCode', 200)
+        if status == 304:
+            body = b''
+
+        self.send_response(status)
+        for name, value in response.get('headers', {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.closing:
+            self.send_header('Connection', 'close')  # Also ends this connection's keep-alive
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} - {format % args}")
+
+
+class PooledHTTPServer(HTTPServer):
+    # Hands each connection to a fixed pool of worker threads rather than a new thread per request
+    def __init__(self, address, handler, workers):
+        super().__init__(address, handler)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='request')
+        self.connections = set()
+        self.active_requests = 0
+        self.active_lock = threading.Lock()
+        self.closing = False
+
+    def process_request(self, request, client_address):
+        with self.active_lock:
+            self.connections.add(request)
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.active_lock:
+                self.connections.discard(request)
+
+    def server_close(self):
+        # Stop accepting and give requests in progress SERVER_SHUTDOWN_GRACE seconds to finish. Then cut
+        # every remaining connection, which also frees workers waiting on idle keep-alive connections.
+        self.closing = True
+        super().server_close()
+        deadline = time.monotonic() + SERVER_SHUTDOWN_GRACE
+        while self.active_requests and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if self.active_requests:
+            logger.warning(f"{self.active_requests} requests still running after {SERVER_SHUTDOWN_GRACE}s, closing their connections")
+        with self.active_lock:
+            for request in self.connections:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass  # Already closed by the client
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    server = PooledHTTPServer((SERVER_HOST, SERVER_PORT), LambdaRequestHandler, SERVER_WORKERS)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever to return, so it can't run on the thread serving
+        logger.info(f"Received signal {signum}, shutting down")
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logger.info(f"Serving on {SERVER_HOST}:{SERVER_PORT} with {SERVER_WORKERS} workers")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        lambda_function.flush_logs()
+        logger.info("Server stopped")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import os
+import re
+import sys
+import json
+import random
+from datetime import date, timedelta
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+# lambda_function reads its settings on import. Credentials are fake; moto never sends them anywhere.
+os.environ.update({
+    "API_KEY": "test-key",
+    "S3_BUCKET_NAME": "fungi-test-bucket",
+    "UPSTREAM_RATE_LIMIT": "0",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+})
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fungi-function'))
+
+import boto3
+import responses
+from moto import mock_aws
+
+import lambda_function
+
+BUCKET = os.environ['S3_BUCKET_NAME']
+
+
+def make_observations(count=600, start=date(2023, 1, 1), days=31):
+    # Deterministic observations shaped like iNaturalist's, spread over `days` days from `start`
+    generator = random.Random(1)
+    observations = []
+    for number in range(count):
+        observed_on = start + timedelta(days=generator.randrange(days))
+        observations.append({
+            "id": 1000 + number,
+            "observed_on": observed_on.isoformat(),
+            "location": f"-43.{generator.randint(1000, 9999)},172.{generator.randint(1000, 9999)}",
+            "user": {"login": generator.choice(["ann", "bob", "cat"])},
+            "created_at": f"{observed_on.isoformat()}T10:00:00+13:00",
+            "updated_at": f"{observed_on.isoformat()}T10:00:00+13:00",
+            "quality_grade": "research",
+            "taxon": {
+                "name": generator.choice(["Amanita muscaria", "Boletus edulis", "Clathrus ruber"]),
+                "preferred_common_name": "fly agaric",
+                "native": generator.choice([True, False]),
+                "iconic_taxon_name": "Fungi",
+            },
+            "photos": [{"url": "https://static.inaturalist.org/photos/1/square.jpg"}],
+        })
+    return observations
+
+
+def observation(obs_id, observed_on, name, common_name="", location="-43.5,172.6", login="ann", native=True):
+    # One observation shaped like iNaturalist's, for tests that need exact values
+    return {
+        "id": obs_id,
+        "observed_on": observed_on,
+        "location": location,
+        "user": {"login": login},
+        "created_at": f"{observed_on}T10:00:00+13:00",
+        "updated_at": f"{observed_on}T10:00:00+13:00",
+        "quality_grade": "research",
+        "taxon": {"name": name, "preferred_common_name": common_name, "native": native, "iconic_taxon_name": "Fungi"},
+        "photos": [{"url": "https://static.inaturalist.org/photos/1/square.jpg"}],
+    }
+
+
+class FakeINaturalist:
+    # Answers /v1/observations from a fixed list: the date range, updated_since and keyset filters,
+    # both sort orders and page-based paging
+    def __init__(self, observations):
+        self.observations = observations
+        self.calls = []
+        self.fail = None  # Optional query -> status code to answer with instead (None answers normally)
+
+    def __call__(self, request):
+        query = {key: values[0] for key, values in parse_qs(urlparse(request.url).query).items()}
+        self.calls.append(query)
+        status = self.fail(query) if self.fail else None
+        if status:
+            return status, {}, json.dumps({"error": f"status {status}"})
+        results = [obs for obs in self.observations if query.get('d1', '') <= obs['observed_on'] <= query.get('d2', '9999')]
+        if 'updated_since' in query:
+            results = [obs for obs in results if obs['updated_at'] >= query['updated_since']]
+        if 'id_below' in query:
+            results = [obs for obs in results if obs['id'] < int(query['id_below'])]
+        if 'id_above' in query:
+            results = [obs for obs in results if obs['id'] > int(query['id_above'])]
+        results.sort(key=lambda obs: obs['id'], reverse=query.get('order') != 'asc')
+        per_page = int(query.get('per_page', 30))
+        start = (int(query.get('page', 1)) - 1) * per_page
+        body = {"total_results": len(results), "per_page": per_page, "results": results[start:start + per_page]}
+        return 200, {}, json.dumps(body)
+
+
+@pytest.fixture
+def s3():
+    # An empty bucket in moto's in-memory S3
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def inaturalist(s3):
+    # Registered inside moto's mock, which would otherwise pass unmatched requests on to the network
+    fake = FakeINaturalist(make_observations())
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as mock:
+        mock.add_callback(responses.GET, re.compile(r"https://api\.inaturalist\.org/.*"), callback=fake)
+        yield fake
+
+
+@pytest.fixture(autouse=True)
+def isolated_function(tmp_path, monkeypatch):
+    # Fresh caches and clients for every test, with nothing written outside tmp_path
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_CACHE_DIR', str(tmp_path / 'observation_cache'))
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_STORE_PATH', str(tmp_path / 'observations.sqlite3'))
+    monkeypatch.setattr(lambda_function, 'upload_log_to_s3', lambda *args, **kwargs: None)
+    monkeypatch.setattr(lambda_function, '_s3_client', None)
+    monkeypatch.setattr(lambda_function, '_upstream_governor', None)
+    monkeypatch.setattr(lambda_function, '_default_window', None)
+    monkeypatch.setattr(lambda_function, '_summary_cache', {})
+    monkeypatch.setattr(lambda_function, '_tile_cache', {})
+    monkeypatch.setattr(lambda_function, '_column_types', None)
+    monkeypatch.setattr(lambda_function, '_column_types_expire_at', None)
+    monkeypatch.setattr(lambda_function, '_metadata_cache', {})
+
+
+def data_event(**query):
+    return {
+        "requestContext": {"path": "/data"},
+        "queryStringParameters": {"api_key": "test-key", **query},
+    }
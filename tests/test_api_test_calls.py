@@ -0,0 +1,57 @@
+import os
+import json
+
+import pytest
+
+import lambda_function
+from conftest import BUCKET
+
+PAYLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api_test_calls')
+METADATA_FILE = os.path.join(os.path.dirname(PAYLOAD_DIR), 'metadata_v1-0-0.json')
+
+# The status each payload in api_test_calls should get. A new payload has to be listed here.
+EXPECTED_STATUS = {
+    "input_endNoStartDates_validAPIKey.json": 400,
+    "input_invalidDates_validAPIKey.json": 400,
+    "input_metadata_Version.json": 200,
+    "input_metadata_noVersion.json": 200,
+    "input_noDates_invalidAPIKey.json": 401,
+    "input_noDates_validAPIKey.json": 200,
+    "input_startNoEndDates_validAPIKey.json": 400,
+    "input_validDates_validAPIKey.json": 200,
+    "input_wrongOrderDates_validAPIKey.json": 400,
+    "input_yearDates_validAPIKey.json": 200,
+    "input_ndjsonFormat_validAPIKey.json": 200,
+    "input_parquetFormat_validAPIKey.json": 200,
+    "input_invalidFormat_validAPIKey.json": 400,
+    "input_taxonFilter_validAPIKey.json": 200,
+    "input_userNativeFilters_validAPIKey.json": 200,
+    "input_bboxFilter_validAPIKey.json": 200,
+    "input_invalidBbox_validAPIKey.json": 400,
+    "input_invalidNative_validAPIKey.json": 400,
+    "input_summary_yearDates.json": 200,
+    "input_summary_noDates.json": 200,
+    "input_summary_startNoEndDates.json": 400,
+    "input_tiles_christchurch.json": 200,
+    "input_tiles_noDates.json": 200,
+    "input_tiles_outOfRange.json": 400,
+}
+
+
+def test_every_payload_has_an_expected_status():
+    assert sorted(name for name in os.listdir(PAYLOAD_DIR) if name.endswith('.json')) == sorted(EXPECTED_STATUS)
+
+
+@pytest.mark.parametrize('name', sorted(EXPECTED_STATUS))
+def test_payload(name, inaturalist, s3, monkeypatch):
+    # The payloads carry the placeholder key "*****"
+    monkeypatch.setenv('API_KEY', '*****')
+    monkeypatch.setattr(lambda_function, '_metadata_cache', {})
+    with open(METADATA_FILE, 'rb') as metadata_file:
+        s3.put_object(Bucket=BUCKET, Key='metadata/metadata_v1-0-0.json', Body=metadata_file.read())
+    with open(os.path.join(PAYLOAD_DIR, name)) as payload_file:
+        event = json.load(payload_file)
+
+    response = lambda_function.lambda_handler(event, None)
+
+    assert response['statusCode'] == EXPECTED_STATUS[name], response.get('body')
@@ -0,0 +1,67 @@
+import zlib
+import base64
+
+import pytest
+
+import lambda_function
+from conftest import data_event
+
+RANGE = {"start_date": "2023-01-01", "end_date": "2023-01-31"}
+
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    ("gzip", "gzip"),
+    ("deflate", "deflate"),
+    ("GZIP", "gzip"),
+    ("gzip, deflate", "gzip"),
+    ("deflate, gzip", "gzip"),  # Equally acceptable: gzip wins
+    ("gzip;q=0.5, deflate", "deflate"),
+    ("gzip; q=0.8, deflate; q=0.9", "deflate"),
+    ("deflate;q=0.2, gzip;q=0.1", "deflate"),
+    ("gzip;q=0, deflate", "deflate"),
+    ("gzip;q=0, deflate;q=0", None),
+    ("gzip;q=abc, deflate;q=0.1", "deflate"),  # An unreadable q-value counts as not acceptable
+    ("*", "gzip"),
+    ("*;q=0.5, gzip;q=0", "deflate"),
+    ("*;q=0", None),
+    ("br, identity", None),
+    ("", None),
+])
+def test_encoding_is_negotiated_from_q_values(accept_encoding, expected):
+    assert lambda_function.negotiate_encoding({"Accept-Encoding": accept_encoding}) == expected
+
+
+def test_header_names_are_case_insensitive_and_compression_can_be_turned_off(monkeypatch):
+    assert lambda_function.negotiate_encoding({"accept-encoding": "deflate"}) == "deflate"
+    assert lambda_function.negotiate_encoding(None) is None
+    monkeypatch.setattr(lambda_function, 'COMPRESSION_ENABLED', False)
+    assert lambda_function.negotiate_encoding({"Accept-Encoding": "gzip"}) is None
+
+
+@pytest.mark.parametrize("encoding, wbits", [("gzip", zlib.MAX_WBITS | 16), ("deflate", zlib.MAX_WBITS)])
+def test_data_is_compressed_with_the_negotiated_encoding(inaturalist, encoding, wbits):
+    plain = lambda_function.lambda_handler(data_event(**RANGE), None)
+    event = data_event(**RANGE)
+    event['headers'] = {"Accept-Encoding": f"{encoding};q=0.9, br"}
+
+    compressed = lambda_function.lambda_handler(event, None)
+
+    assert compressed['isBase64Encoded']
+    assert compressed['headers']['Content-Encoding'] == encoding
+    assert compressed['headers']['Vary'] == 'Accept-Encoding'
+    assert zlib.decompress(base64.b64decode(compressed['body']), wbits).decode('utf-8') == plain['body']
+
+
+def test_small_and_failed_responses_are_sent_as_they_are():
+    small = {"statusCode": 200, "headers": {}, "body": "id\n"}
+    failed = {"statusCode": 400, "body": "x" * 4096}
+
+    assert lambda_function.compress_response(dict(small), 'gzip') == small
+    assert lambda_function.compress_response(dict(failed), 'gzip') == failed
+
+
+def test_compression_level_follows_the_size_and_the_time_left():
+    assert lambda_function.compression_level(10 * 1024) == 9
+    assert lambda_function.compression_level(1024 * 1024) == 6
+    assert lambda_function.compression_level(8 * 1024 * 1024) == 4
+    assert lambda_function.compression_level(10 * 1024, remaining_ms=lambda_function.COMPRESSION_FAST_MS - 1) == 1
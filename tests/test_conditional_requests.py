@@ -0,0 +1,66 @@
+import pytest
+
+import lambda_function
+from conftest import data_event
+
+RANGE = {"start_date": "2023-01-01", "end_date": "2023-01-31"}
+
+
+def request(accept_encoding=None, if_none_match=None, **query):
+    event = data_event(**RANGE, **query)
+    event['headers'] = {}
+    if accept_encoding:
+        event['headers']['Accept-Encoding'] = accept_encoding
+    if if_none_match:
+        event['headers']['If-None-Match'] = if_none_match
+    return lambda_function.lambda_handler(event, None)
+
+
+@pytest.mark.parametrize("cached", [True, False], ids=["partition tags", "body hash"])
+@pytest.mark.parametrize("encoding", [None, "gzip", "deflate"])
+def test_each_encoding_has_its_own_strong_etag_and_304(inaturalist, monkeypatch, cached, encoding):
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_CACHE_ENABLED', cached)
+    first = request(encoding)
+    etag = first['headers']['ETag']
+
+    second = request(encoding, etag)
+
+    assert first['statusCode'] == 200
+    assert first['headers'].get('Content-Encoding') == encoding
+    assert etag.startswith('"') and etag.endswith(f"-{encoding}\"" if encoding else '"')
+    assert (second['statusCode'], second['body']) == (304, "")
+    assert second['headers']['ETag'] == etag
+    assert second['headers']['Vary'] == 'Accept-Encoding'
+
+
+def test_representations_share_a_tag_apart_from_the_suffix(inaturalist):
+    plain = request()['headers']['ETag']
+    gzipped = request("gzip")['headers']['ETag']
+    deflated = request("deflate")['headers']['ETag']
+
+    assert (gzipped, deflated) == (plain[:-1] + '-gzip"', plain[:-1] + '-deflate"')
+    # A client that cached the gzip body may ask without Accept-Encoding; the 304 names what it holds
+    assert request(None, gzipped)['headers']['ETag'] == gzipped
+    assert request("gzip", f'W/{deflated}')['headers']['ETag'] == deflated
+    assert request("gzip", '*')['headers']['ETag'] == plain
+
+
+def test_a_match_skips_serializing(inaturalist, monkeypatch):
+    etag = request("gzip")['headers']['ETag']
+
+    def unexpected(*args, **kwargs):
+        raise AssertionError("serialized a body for a 304")
+    monkeypatch.setattr(lambda_function, 'iter_output_chunks', unexpected)
+
+    assert request("gzip", etag)['statusCode'] == 304
+
+
+def test_other_tags_formats_and_changes_get_the_body(inaturalist, monkeypatch):
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_CACHE_ENABLED', False)
+    etag = request()['headers']['ETag']
+
+    assert request(None, '"something-else", W/"other"')['statusCode'] == 200
+    assert request(None, etag, format="ndjson")['statusCode'] == 200
+    assert request(None, etag, taxon="Amanita muscaria")['statusCode'] == 200
+    inaturalist.observations[0]['taxon']['name'] = "Amanita pantherina"
+    assert request(None, etag)['statusCode'] == 200
@@ -0,0 +1,88 @@
+import gzip
+import json
+import base64
+from datetime import date, timedelta
+
+import pytest
+
+import lambda_function
+from conftest import data_event, observation
+
+SCHEDULED_EVENT = {"detail-type": "Scheduled Event", "source": "aws.events", "detail": {}}
+
+
+@pytest.fixture
+def recent(inaturalist, monkeypatch):
+    # Observations inside the default window, fetched straight from iNaturalist whenever the
+    # materialized copy isn't used
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_CACHE_ENABLED', False)
+    inaturalist.observations = [
+        observation(100 + number, (date.today() - timedelta(days=number)).isoformat(), "Amanita muscaria", "fly agaric")
+        for number in range(1, 29)
+    ]
+    return inaturalist
+
+
+def warm():
+    response = lambda_function.lambda_handler(SCHEDULED_EVENT, None)
+    assert response['statusCode'] == 200
+    return json.loads(response['body'])
+
+
+def test_scheduled_event_materializes_the_default_window(recent):
+    warmed = warm()
+    calls = len(recent.calls)
+
+    response = lambda_function.lambda_handler(data_event(), None)
+
+    assert warmed['materialized'] and calls
+    assert len(recent.calls) == calls
+    assert response['statusCode'] == 200
+    assert response['body'] == lambda_function._default_window['response']['body']
+    assert warmed['bytes'] == len(response['body'])
+    assert len(response['body'].splitlines()) == len(recent.observations) + 1
+
+
+def test_materialized_window_answers_conditional_and_compressed_requests(recent):
+    warm()
+    plain = lambda_function.lambda_handler(data_event(), None)
+    calls = len(recent.calls)
+    conditional = data_event()
+    conditional['headers'] = {"If-None-Match": plain['headers']['ETag']}
+    compressed = data_event()
+    compressed['headers'] = {"Accept-Encoding": "gzip"}
+
+    not_modified = lambda_function.lambda_handler(conditional, None)
+    gzipped = lambda_function.lambda_handler(compressed, None)
+
+    assert len(recent.calls) == calls
+    assert not_modified['statusCode'] == 304
+    assert gzipped['headers']['Content-Encoding'] == 'gzip'
+    assert gzipped['isBase64Encoded']
+    assert base64.b64decode(gzipped['body']) == lambda_function._default_window['encoded']['gzip']
+    assert gzip.decompress(base64.b64decode(gzipped['body'])).decode('utf-8') == plain['body']
+
+
+@pytest.mark.parametrize("expire", [
+    lambda materialized: materialized.update(built_at=materialized['built_at'] - lambda_function.DEFAULT_WINDOW_MAX_AGE),
+    lambda materialized: materialized.update(end_date=materialized['end_date'] - timedelta(days=1)),
+], ids=["too old", "day changed"])
+def test_expired_window_is_fetched_again(recent, expire):
+    warm()
+    expire(lambda_function._default_window)
+    calls = len(recent.calls)
+
+    response = lambda_function.lambda_handler(data_event(), None)
+
+    assert response['statusCode'] == 200
+    assert len(recent.calls) > calls
+
+
+def test_requests_the_window_cannot_answer_are_fetched(recent):
+    warm()
+    calls = len(recent.calls)
+
+    response = lambda_function.lambda_handler(data_event(format="ndjson"), None)
+
+    assert response['statusCode'] == 200
+    assert len(recent.calls) > calls
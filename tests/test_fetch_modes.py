@@ -0,0 +1,197 @@
+import time
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import lambda_function
+
+START, END = date(2023, 1, 1), date(2023, 1, 31)
+
+
+def params(per_page=10):
+    return {**lambda_function.observation_params(START, END), "per_page": per_page}
+
+
+def page_calls(inaturalist):
+    return [call for call in inaturalist.calls if call.get('per_page') != '0']
+
+
+@pytest.fixture
+def sharded(monkeypatch):
+    monkeypatch.setattr(lambda_function, 'FETCH_MODE', 'sharded')
+    monkeypatch.setattr(lambda_function, 'FETCH_WORKERS', 2)
+    monkeypatch.setattr(lambda_function, 'SHARD_TARGET_RESULTS', 100)
+
+
+def test_sharded_pages_cover_the_range_newest_window_first(inaturalist, sharded):
+    stats = {}
+
+    pages = list(lambda_function.iter_pages(params(), stats))
+
+    observations = [obs for page in pages for obs in page]
+    assert sorted(obs['id'] for obs in observations) == sorted(obs['id'] for obs in inaturalist.observations)
+    assert stats['expected_rows'] == len(inaturalist.observations)
+    assert all(len(page) <= 10 for page in pages)
+    with ThreadPoolExecutor() as executor:
+        shards = lambda_function.plan_shards(params(), executor)
+    shard_of = [next(number for number, (d1, d2, count) in enumerate(shards) if d1.isoformat() <= obs['observed_on'] <= d2.isoformat())
+                for obs in observations]
+    assert shard_of == sorted(shard_of)
+
+
+def test_sharded_fetching_waits_for_the_consumer(inaturalist, sharded):
+    pages = lambda_function.iter_pages(params())
+    next(pages)
+    time.sleep(0.5)
+
+    # Two running shards, each with at most SHARD_QUEUE_PAGES queued, one being put and one handed out
+    assert len(page_calls(inaturalist)) <= 2 * (lambda_function.SHARD_QUEUE_PAGES + 2)
+    pages.close()
+    fetched = len(page_calls(inaturalist))
+    time.sleep(0.3)
+    assert len(page_calls(inaturalist)) == fetched
+
+
+def test_sharded_errors_reach_the_consumer(inaturalist, sharded):
+    inaturalist.fail = lambda query: 502 if query.get('per_page') != '0' and query['d1'] < '2023-01-10' else None
+
+    with pytest.raises(lambda_function.UpstreamError) as raised:
+        list(lambda_function.iter_pages(params()))
+
+    assert raised.value.status_code == 502
+
+
+@pytest.fixture
+def asynchronous(monkeypatch):
+    monkeypatch.setattr(lambda_function, 'FETCH_MODE', 'async')
+    monkeypatch.setattr(lambda_function, 'FETCH_WORKERS', 2)
+    monkeypatch.setattr(lambda_function, 'ASYNC_QUEUE_PAGES', 2)
+
+
+def test_async_pages_arrive_in_page_order(inaturalist, asynchronous):
+    stats = {}
+
+    pages = list(lambda_function.iter_pages(params(), stats))
+
+    ids = [obs['id'] for page in pages for obs in page]
+    assert ids == sorted((obs['id'] for obs in inaturalist.observations), reverse=True)
+    assert stats['expected_rows'] == len(inaturalist.observations)
+
+
+def test_async_fetching_waits_for_the_consumer_and_stops_on_close(inaturalist, asynchronous):
+    pages = lambda_function.iter_pages(params())
+    next(pages)
+    time.sleep(0.5)
+
+    # The queue, the pages requested ahead of it, one waiting to be queued and the one handed out
+    assert len(page_calls(inaturalist)) <= lambda_function.ASYNC_QUEUE_PAGES + 2 * lambda_function.FETCH_WORKERS + 2
+    pages.close()
+    fetched = len(page_calls(inaturalist))
+    time.sleep(0.3)
+    assert len(page_calls(inaturalist)) == fetched
+
+
+def test_async_errors_reach_the_consumer(inaturalist, asynchronous):
+    inaturalist.fail = lambda query: 422 if query.get('page') == '4' else None
+
+    pages = lambda_function.iter_pages(params())
+
+    assert len(next(pages)) == 10
+    with pytest.raises(lambda_function.UpstreamError) as raised:
+        list(pages)
+    assert raised.value.status_code == 422
+
+
+def test_async_fetches_count_towards_the_request_metrics(inaturalist, asynchronous):
+    metrics = lambda_function.RequestMetrics('/data')
+    token = lambda_function._request_metrics.set(metrics)
+    try:
+        pages = list(lambda_function.iter_pages(params()))
+    finally:
+        lambda_function._request_metrics.reset(token)
+
+    assert metrics.counters['pages'] == len(pages)
+    assert metrics.timings['upstream'] > 0
+
+
+@pytest.fixture
+def concurrent(monkeypatch):
+    monkeypatch.setattr(lambda_function, 'FETCH_MODE', 'concurrent')
+    monkeypatch.setattr(lambda_function, 'FETCH_WORKERS', 2)
+
+
+def test_concurrent_pages_arrive_in_page_order(inaturalist, concurrent):
+    stats = {}
+
+    pages = list(lambda_function.iter_pages(params(), stats))
+
+    assert [len(page) for page in pages] == [10] * 60
+    ids = [obs['id'] for page in pages for obs in page]
+    assert ids == sorted((obs['id'] for obs in inaturalist.observations), reverse=True)
+    assert stats['expected_rows'] == len(inaturalist.observations)
+    assert sorted(int(call['page']) for call in page_calls(inaturalist)) == list(range(1, 61))
+
+
+def test_concurrent_fetching_looks_ahead_a_bounded_window(inaturalist, concurrent):
+    pages = lambda_function.iter_pages(params())
+    next(pages)
+    next(pages)
+    time.sleep(0.3)
+
+    # The first page, then at most 2 * FETCH_WORKERS submitted ahead of the consumer
+    assert len(page_calls(inaturalist)) <= 1 + 2 * lambda_function.FETCH_WORKERS
+    pages.close()
+    fetched = len(page_calls(inaturalist))
+    time.sleep(0.3)
+    assert len(page_calls(inaturalist)) == fetched
+
+
+def test_concurrent_errors_are_reported_for_the_first_failing_page(inaturalist, concurrent):
+    # Page 5 fails too, and may well fail first, but page 3 comes first in the body
+    inaturalist.fail = lambda query: {'3': 422, '5': 404}.get(query.get('page'))
+    pages = lambda_function.iter_pages(params())
+
+    received = [next(pages), next(pages)]
+    with pytest.raises(lambda_function.UpstreamError) as raised:
+        next(pages)
+
+    assert [obs['id'] for page in received for obs in page] == list(range(1599, 1579, -1))
+    assert raised.value.status_code == 422
+
+
+def test_keyset_walk_uses_the_last_id_as_the_cursor(inaturalist, monkeypatch):
+    monkeypatch.setattr(lambda_function, 'FETCH_MODE', 'keyset')
+    stats = {}
+
+    pages = list(lambda_function.iter_pages(params(per_page=100), stats))
+
+    ids = [obs['id'] for page in pages for obs in page]
+    assert ids == sorted((obs['id'] for obs in inaturalist.observations), reverse=True)
+    assert stats['expected_rows'] == len(inaturalist.observations)
+    assert all((call['order_by'], call['order']) == ('id', 'desc') and 'page' not in call for call in inaturalist.calls)
+    # No cursor for the first page, then the last id of the page before; the empty page ends the walk
+    assert [call.get('id_below') for call in inaturalist.calls] == [None] + [str(page[-1]['id']) for page in pages[:-1]]
+    assert pages[-1] == []
+
+
+def test_keyset_walk_is_not_shifted_by_new_observations(inaturalist, monkeypatch):
+    monkeypatch.setattr(lambda_function, 'FETCH_MODE', 'keyset')
+    expected = sorted((obs['id'] for obs in inaturalist.observations), reverse=True)
+    pages = lambda_function.iter_pages(params(per_page=100))
+
+    first = next(pages)
+    inaturalist.observations.insert(0, {**inaturalist.observations[0], "id": 5000})
+    rest = [obs for page in pages for obs in page]
+
+    assert [obs['id'] for obs in first + rest] == expected
+
+
+def test_deep_ranges_switch_from_pages_to_keyset(inaturalist, concurrent, monkeypatch):
+    monkeypatch.setattr(lambda_function, 'MAX_PAGED_RESULTS', 100)
+
+    pages = list(lambda_function.iter_pages(params(per_page=100)))
+
+    assert sorted(obs['id'] for page in pages for obs in page) == sorted(obs['id'] for obs in inaturalist.observations)
+    assert not any(int(call.get('page', 1)) > 1 for call in inaturalist.calls)
+    assert sum('id_below' in call for call in inaturalist.calls) == 6
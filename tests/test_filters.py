@@ -0,0 +1,92 @@
+import csv
+import io
+import sqlite3
+
+import pytest
+
+import lambda_function
+from conftest import data_event
+
+RANGE = {"start_date": "2023-01-01", "end_date": "2023-01-31"}
+
+
+def located_in(obs, min_lng, min_lat, max_lng, max_lat):
+    latitude, longitude = (float(value) for value in obs['location'].split(','))
+    return min_lat <= latitude <= max_lat and min_lng <= longitude <= max_lng
+
+
+# Each filter, and which of the fake observations it should keep
+FILTERS = [
+    ({"taxon": "amanita"}, lambda obs: obs['taxon']['name'].startswith('Amanita ')),
+    ({"taxon": "Boletus edulis"}, lambda obs: obs['taxon']['name'] == 'Boletus edulis'),
+    ({"taxon": "Fly Agaric"}, lambda obs: True),
+    ({"taxon": "Amanitaceae"}, lambda obs: False),
+    ({"taxon": "Amanita musc"}, lambda obs: False),
+    ({"user": "ANN"}, lambda obs: obs['user']['login'] == 'ann'),
+    ({"native": "true", "user": "bob"}, lambda obs: obs['taxon']['native'] and obs['user']['login'] == 'bob'),
+    ({"bbox": "172.3,-43.6,172.7,-43.2", "native": "false"},
+     lambda obs: not obs['taxon']['native'] and located_in(obs, 172.3, -43.6, 172.7, -43.2)),
+]
+
+
+def rows(response):
+    assert response['statusCode'] == 200
+    return list(csv.reader(io.StringIO(response['body'])))[1:]
+
+
+def test_filtered_requests_leave_the_partition_cache_whole(inaturalist, s3, monkeypatch):
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_STORE_ENABLED', False)
+
+    filtered = rows(lambda_function.lambda_handler(data_event(user='ann', **RANGE), None))
+    unfiltered = rows(lambda_function.lambda_handler(data_event(**RANGE), None))
+
+    assert filtered and {row[4] for row in filtered} == {'ann'}
+    assert len(unfiltered) == len(inaturalist.observations)
+    assert not any({'user_login', 'taxon_name', 'native', 'swlat'} & set(call) for call in inaturalist.calls)
+
+
+@pytest.mark.parametrize('filters, keeps', FILTERS)
+def test_store_and_fallback_agree(filters, keeps, inaturalist, s3, monkeypatch):
+    from_store = rows(lambda_function.lambda_handler(data_event(**filters, **RANGE), None))
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_STORE_ENABLED', False)
+    filtered_directly = rows(lambda_function.lambda_handler(data_event(**filters, **RANGE), None))
+
+    assert from_store == filtered_directly
+    assert sorted(int(row[0]) for row in from_store) == sorted(obs['id'] for obs in inaturalist.observations if keeps(obs))
+
+
+def test_store_connection_is_closed_when_loading_fails(monkeypatch):
+    opened = []
+    open_store = lambda_function.open_observation_store
+    monkeypatch.setattr(lambda_function, 'open_observation_store', lambda: opened.append(open_store()) or opened[-1])
+
+    def unreachable(*args, **kwargs):
+        raise lambda_function.UpstreamError(502, '{"error": "Could not reach iNaturalist."}')
+        yield
+    monkeypatch.setattr(lambda_function, 'iter_observations_cached', unreachable)
+
+    response = lambda_function.lambda_handler(data_event(user='ann', **RANGE), None)
+
+    assert response['statusCode'] == 502
+    with pytest.raises(sqlite3.ProgrammingError):
+        opened[0].execute("SELECT 1")
+
+
+def test_unused_days_are_dropped_from_the_store(inaturalist, s3):
+    def stored_days():
+        connection = sqlite3.connect(lambda_function.OBSERVATION_STORE_PATH)
+        try:
+            return {day for (day,) in connection.execute("SELECT DISTINCT day FROM observations")}
+        finally:
+            connection.close()
+
+    lambda_function.lambda_handler(data_event(user='ann', start_date='2023-01-01', end_date='2023-01-10'), None)
+    connection = sqlite3.connect(lambda_function.OBSERVATION_STORE_PATH)
+    with connection:
+        connection.execute("UPDATE store_days SET used_at = used_at - ?", (lambda_function.OBSERVATION_STORE_RETENTION + 1,))
+    connection.close()
+    assert min(stored_days()) == '2023-01-01'
+
+    lambda_function.lambda_handler(data_event(user='ann', start_date='2023-01-20', end_date='2023-01-31'), None)
+
+    assert stored_days() and min(stored_days()) >= '2023-01-20'
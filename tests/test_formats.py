@@ -0,0 +1,69 @@
+import io
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+import lambda_function
+from conftest import make_observations, observation
+
+
+def row_pages(page_rows=50):
+    rows = [lambda_function.observation_row(obs) for obs in make_observations()]
+    return [rows[start:start + page_rows] for start in range(0, len(rows), page_rows)]
+
+
+def awkward_observations():
+    # Values the CSV writer has to quote or escape, and fields that are missing altogether
+    quoted = observation(1, "2023-01-02", "Amanita muscaria", 'fly "agaric", red', login="o'brien")
+    multiline = observation(2, "2023-01-03", "Hygrocybe\nrubrocarnosa", "wax cap", native=False)
+    unicode = observation(3, "2023-01-04", "Cortinarius archeri", "émperor cortinar")
+    unicode['taxon']['native'] = None
+    sparse = {"id": 4}
+    return [quoted, multiline, unicode, sparse] + make_observations(50)
+
+
+def test_csv_matches_the_dataframe_output_byte_for_byte():
+    rows = [lambda_function.observation_row(obs) for obs in awkward_observations()]
+    pages = [rows[:3], [], rows[3:]]
+
+    body = ''.join(lambda_function.iter_csv_pages(pages))
+
+    assert body == pd.DataFrame(rows, columns=list(lambda_function.CSV_COLUMNS)).to_csv(index=False)
+
+
+def test_empty_csv_is_the_header_row():
+    assert ''.join(lambda_function.iter_csv_pages([])) == ','.join(lambda_function.CSV_COLUMNS) + '\n'
+
+
+def test_parquet_is_streamed_a_row_group_at_a_time(monkeypatch):
+    monkeypatch.setattr(lambda_function, 'PARQUET_ROW_GROUP_ROWS', 100)
+    monkeypatch.setattr(lambda_function, 'load_metadata', lambda version: {"metadata": {}})
+
+    chunks = list(lambda_function.iter_parquet_chunks(row_pages()))
+
+    assert len(chunks) == 7  # Six row groups, then the footer
+    parquet_file = pq.ParquetFile(io.BytesIO(b''.join(chunks)))
+    assert parquet_file.metadata.num_row_groups == 6
+    table = parquet_file.read()
+    assert table.column_names == list(lambda_function.CSV_COLUMNS)
+    assert table.column('id').to_pylist() == [str(obs['id']) for obs in make_observations()]
+
+
+def test_column_type_defaults_are_cached_until_they_expire(monkeypatch):
+    reads = []
+
+    def unreadable(version):
+        reads.append(version)
+        raise RuntimeError("metadata unavailable")
+    monkeypatch.setattr(lambda_function, 'load_metadata', unreadable)
+
+    first = lambda_function.get_column_types()
+    second = lambda_function.get_column_types()
+    assert first == second == [lambda_function.DEFAULT_COLUMN_TYPES[column] for column in lambda_function.CSV_COLUMNS]
+    assert len(reads) == 1
+
+    monkeypatch.setattr(lambda_function, '_column_types_expire_at', 0.0)
+    monkeypatch.setattr(lambda_function, 'load_metadata', lambda version: {"metadata": {"attributes": [{"name": "id", "type": "Integer"}]}})
+
+    assert lambda_function.get_column_types()[0] == "Integer"
+    assert lambda_function._column_types_expire_at is None
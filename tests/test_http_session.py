@@ -0,0 +1,49 @@
+import re
+from datetime import date
+
+import pytest
+import requests
+import responses
+
+import lambda_function
+
+
+@pytest.fixture
+def fresh_session(monkeypatch):
+    monkeypatch.setattr(lambda_function, '_http_session', None)
+    monkeypatch.setattr(lambda_function, 'HTTP_BACKOFF_FACTOR', 0)
+
+
+def test_one_pooled_session_is_shared(fresh_session):
+    session = lambda_function.get_http_session()
+
+    assert lambda_function.get_http_session() is session
+    adapter = session.get_adapter(lambda_function.INAT_OBSERVATIONS_URL)
+    assert adapter._pool_maxsize == lambda_function.FETCH_WORKERS
+    assert session.headers['User-Agent'] == 'christchurch-fungi-reportings'
+
+
+def test_only_connection_failures_are_retried_by_the_adapter(fresh_session):
+    retry = lambda_function.get_http_session().get_adapter(lambda_function.INAT_OBSERVATIONS_URL).max_retries
+
+    assert retry.connect == lambda_function.HTTP_MAX_RETRIES
+    assert (retry.read, retry.status, retry.other) == (0, 0, 0)
+    assert not retry.status_forcelist
+    assert not retry.respect_retry_after_header
+    assert not retry.raise_on_status
+
+
+@pytest.mark.parametrize("failure, status", [
+    (requests.exceptions.ReadTimeout("read timed out"), 504),
+    (requests.exceptions.ConnectionError("connection refused"), 502),
+])
+def test_failed_requests_map_to_gateway_errors(fresh_session, failure, status):
+    with responses.RequestsMock() as mock:
+        mock.add(responses.GET, re.compile(r"https://api\.inaturalist\.org/.*"), body=failure)
+
+        with pytest.raises(lambda_function.UpstreamError) as raised:
+            lambda_function.fetch_page(lambda_function.observation_params(date(2023, 1, 1), date(2023, 1, 31)), 1)
+
+        # Timeouts reached iNaturalist and are retried by fetch_page; refused connections never did
+        assert len(mock.calls) == (lambda_function.HTTP_MAX_RETRIES + 1 if status == 504 else 1)
+    assert raised.value.status_code == status
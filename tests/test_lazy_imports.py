@@ -0,0 +1,72 @@
+import os
+import sys
+import json
+import logging
+import textwrap
+import subprocess
+
+import lambda_function
+from conftest import data_event
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = ("requests", "urllib3", "boto3", "botocore", "pandas", "numpy", "pyarrow")
+
+
+def loaded_in_fresh_interpreter(code):
+    # Runs code after importing lambda_function in a new interpreter; the code prints loaded() and
+    # whatever else it checks as JSON
+    script = textwrap.dedent(f"""
+        import sys, json
+        import lambda_function
+        loaded = lambda: sorted(name for name in {HEAVY_MODULES!r} if name in sys.modules)
+    """) + textwrap.dedent(code)
+    environment = {**os.environ, "PYTHONPATH": os.pathsep.join([os.path.join(os.path.dirname(TESTS), 'fungi-function'), TESTS])}
+    result = subprocess.run([sys.executable, '-c', script], cwd=TESTS, env=environment, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def test_nothing_heavy_is_imported_until_it_is_needed():
+    report = loaded_in_fresh_interpreter("""
+        on_import = loaded()
+        response = lambda_function.lambda_handler(
+            {"requestContext": {"path": "/data"}, "queryStringParameters": {"api_key": "wrong"}}, None)
+        print(json.dumps({"on_import": on_import, "status": response['statusCode'], "after_rejection": loaded()}))
+    """)
+
+    assert report == {"on_import": [], "status": 401, "after_rejection": []}
+
+
+def test_csv_data_does_not_import_pandas():
+    report = loaded_in_fresh_interpreter("""
+        import re, boto3, responses, conftest
+        from moto import mock_aws
+        with mock_aws(), responses.RequestsMock(assert_all_requests_are_fired=False) as mock:
+            boto3.client('s3').create_bucket(Bucket=conftest.BUCKET)
+            mock.add_callback(responses.GET, re.compile(r"https://api\\.inaturalist\\.org/.*"),
+                              callback=conftest.FakeINaturalist(conftest.make_observations()))
+            response = lambda_function.lambda_handler(conftest.data_event(start_date="2023-01-01", end_date="2023-01-31"), None)
+        print(json.dumps({"status": response['statusCode'], "loaded": loaded()}))
+    """)
+
+    assert report['status'] == 200
+    assert 'pandas' not in report['loaded'] and 'numpy' not in report['loaded']
+
+
+def test_import_times_are_reported_once(monkeypatch, caplog):
+    monkeypatch.setattr(lambda_function, 'IMPORT_TIME_REPORT', True)
+    monkeypatch.delitem(sys.modules, 'colorsys', raising=False)
+    lambda_function.import_times.clear()
+    rejected = data_event(api_key="wrong")
+
+    with caplog.at_level(logging.INFO):
+        lambda_function.lazy_import('colorsys')
+        lambda_function.lambda_handler(rejected, None)
+        lambda_function.lazy_import('colorsys')  # Already loaded: not timed again
+        lambda_function.lambda_handler(rejected, None)
+
+    assert len([record for record in caplog.records if record.getMessage().startswith("Imported colorsys in ")]) == 1
+    reports = [record.getMessage() for record in caplog.records if record.getMessage().startswith("Import time report (ms): ")]
+    assert len(reports) == 1
+    assert list(json.loads(reports[0].split(": ", 1)[1])) == ['colorsys']
+    assert lambda_function.import_times == {}
@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+import lambda_function
+from conftest import BUCKET
+
+
+def publish(s3, version, document=None):
+    s3.put_object(Bucket=BUCKET, Key=f"metadata/metadata_v{version.replace('.', '-')}.json",
+                  Body=json.dumps(document or {"version": version}).encode('utf-8'))
+
+
+def metadata_event(version=None, **headers):
+    query = {"api_key": "test-key"}
+    if version is not None:
+        query['metadata_version'] = version
+    return {"requestContext": {"path": "/metadata"}, "queryStringParameters": query, "headers": headers}
+
+
+def metadata(version=None):
+    response = lambda_function.lambda_handler(metadata_event(version), None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+@pytest.mark.parametrize("version, expected", [
+    ("v1.10.0", (1, 10, 0)),
+    ("1.10.0", (1, 10, 0)),
+    ("1-10-0", (1, 10, 0)),
+    (" v2.0.13 ", (2, 0, 13)),
+    ("1.0", None),
+    ("v1.0.0-beta", None),
+    ("LATEST", None),
+])
+def test_versions_are_parsed_into_numbers(version, expected):
+    assert lambda_function.parse_metadata_version(version) == expected
+
+
+def test_manifest_orders_versions_numerically(s3):
+    for version in ["1.9.0", "1.10.0", "1.2.0"]:
+        publish(s3, version)
+    s3.put_object(Bucket=BUCKET, Key="metadata/metadata_vnotes.json", Body=b"{}")
+
+    response = lambda_function.lambda_handler({"action": "update_metadata_manifest"}, None)
+
+    assert response['statusCode'] == 200
+    manifest = json.loads(s3.get_object(Bucket=BUCKET, Key=lambda_function.METADATA_MANIFEST_KEY)['Body'].read())
+    assert json.loads(response['body']) == manifest
+    assert manifest['versions'] == ["1.2.0", "1.9.0", "1.10.0"]
+    assert (manifest['latest'], manifest['key']) == ("1.10.0", "metadata/metadata_v1-10-0.json")
+
+
+def test_latest_builds_the_manifest_on_first_use_and_follows_updates(s3):
+    publish(s3, "1.9.0")
+    publish(s3, "1.10.0")
+
+    assert metadata() == (200, {"version": "1.10.0"})
+    assert s3.get_object(Bucket=BUCKET, Key=lambda_function.METADATA_MANIFEST_KEY)
+    publish(s3, "1.11.0")
+    lambda_function.lambda_handler({"action": "update_metadata_manifest"}, None)
+    assert metadata("LATEST") == (200, {"version": "1.11.0"})
+    assert metadata("v1.9.0") == (200, {"version": "1.9.0"})
+
+
+def test_missing_and_malformed_versions(s3):
+    assert metadata()[0] == 404  # Nothing published yet
+    assert lambda_function.lambda_handler({"action": "update_metadata_manifest"}, None)['statusCode'] == 404
+    publish(s3, "1.0.0")
+
+    assert metadata("v2.0.0") == (404, {"error": "Metadata version v2.0.0 not found"})
+    assert metadata("banana")[0] == 400
+
+
+def test_metadata_is_revalidated_once_stale(s3, monkeypatch):
+    publish(s3, "1.0.0")
+    reads = []
+    lambda_function.get_s3_client().meta.events.register(
+        'before-parameter-build.s3.GetObject', lambda params, **kwargs: reads.append(params.get('IfNoneMatch')))
+
+    metadata("v1.0.0")
+    metadata("v1.0.0")
+    monkeypatch.setattr(lambda_function, 'METADATA_CACHE_TTL', 0)
+    publish(s3, "1.0.0", {"version": "1.0.0", "revised": True})
+    revised = metadata("v1.0.0")
+
+    assert reads[0] is None and len(reads) == 2  # The second request was served from memory
+    assert reads[1]  # Revalidated with the cached ETag, and the changed object downloaded
+    assert revised == (200, {"version": "1.0.0", "revised": True})
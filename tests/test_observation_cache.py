@@ -0,0 +1,87 @@
+import os
+import gzip
+import json
+from datetime import date
+
+import pytest
+
+import lambda_function
+from conftest import BUCKET, data_event
+
+RANGE = {"start_date": "2023-01-01", "end_date": "2023-01-31"}
+
+
+def test_cold_range_matches_an_uncached_fetch(inaturalist, s3, monkeypatch):
+    cached = lambda_function.lambda_handler(data_event(**RANGE), None)
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_CACHE_ENABLED', False)
+
+    uncached = lambda_function.lambda_handler(data_event(**RANGE), None)
+
+    # Cached rows come newest day first; the fake iNaturalist orders by id
+    assert sorted(cached['body'].splitlines()) == sorted(uncached['body'].splitlines())
+
+
+def test_fetched_runs_are_spooled_to_one_partition_per_day(inaturalist, s3):
+    days = lambda_function.date_range(date(2023, 1, 1), date(2023, 1, 31))
+
+    headers = lambda_function.fetch_partitions(lambda_function.observation_params(days[0], days[-1]), days)
+
+    assert sum(header['rows'] for header in headers.values()) == len(inaturalist.observations)
+    for day in days:
+        partition = lambda_function.read_partition(day)
+        assert [obs['observed_on'] for obs in partition['observations']] == [day.isoformat()] * headers[day]['rows']
+        assert partition['content_hash'] == headers[day]['content_hash']
+    assert not [name for name in os.listdir(lambda_function.OBSERVATION_CACHE_DIR) if name.endswith('.spool')]
+
+
+def test_days_that_cannot_be_spooled_are_held_in_memory(inaturalist, s3, tmp_path, monkeypatch):
+    days = lambda_function.date_range(date(2023, 1, 1), date(2023, 1, 31))
+    params = lambda_function.observation_params(days[0], days[-1])
+    expected = lambda_function.fetch_partitions(params, days)
+    monkeypatch.setattr(lambda_function, 'spool_path', lambda day: str(tmp_path / 'missing' / f"{day}.spool"))
+
+    held = lambda_function.fetch_partitions(params, days)
+
+    assert {day: header['content_hash'] for day, header in held.items()} == \
+        {day: header['content_hash'] for day, header in expected.items()}
+
+
+@pytest.fixture
+def always_sync(monkeypatch):
+    # Every cached day is due for an incremental sync on every request
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_CACHE_SYNC_INTERVAL', 0)
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_CACHE_RECENT_TTL', 0)
+
+
+def served_ids(response):
+    assert response['statusCode'] == 200
+    return {int(line.split(',')[0]) for line in response['body'].splitlines()[1:]}
+
+
+def test_sync_drops_observations_reidentified_out_of_fungi(inaturalist, s3, always_sync):
+    lambda_function.lambda_handler(data_event(**RANGE), None)
+    moved = inaturalist.observations[0]
+    moved['taxon'] = {**moved['taxon'], "name": "Hypogymnia", "iconic_taxon_name": "Plantae"}
+    moved['updated_at'] = "2099-01-01T00:00:00+00:00"
+
+    response = lambda_function.lambda_handler(data_event(**RANGE), None)
+
+    assert moved['id'] not in served_ids(response)
+    syncs = [call for call in inaturalist.calls if 'updated_since' in call]
+    assert syncs and not any('iconic_taxa' in call or 'quality_grade' in call for call in syncs)
+
+
+def test_deleted_observations_go_at_the_next_full_refetch(inaturalist, s3, always_sync, monkeypatch):
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_CACHE_REFETCH_SYNCS', 1)
+    lambda_function.lambda_handler(data_event(**RANGE), None)
+    deleted = inaturalist.observations.pop(0)
+    day = date.fromisoformat(deleted['observed_on'])
+
+    synced = lambda_function.lambda_handler(data_event(**RANGE), None)
+    refetched = lambda_function.lambda_handler(data_event(**RANGE), None)
+
+    assert deleted['id'] in served_ids(synced)  # updated_since never mentions it
+    assert deleted['id'] not in served_ids(refetched)
+    assert lambda_function.read_partition(day).get('syncs', 0) == 0
+    shared = s3.get_object(Bucket=BUCKET, Key=lambda_function.s3_partition_key(day))['Body'].read()
+    assert deleted['id'] not in [obs['id'] for obs in json.loads(gzip.decompress(shared))['observations']]
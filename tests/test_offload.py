@@ -0,0 +1,102 @@
+import io
+import json
+
+import pytest
+import moto.s3.models
+import pyarrow.parquet as pq
+
+import lambda_function
+from conftest import BUCKET, data_event
+
+RANGE = {"start_date": "2023-01-01", "end_date": "2023-01-31"}
+
+
+@pytest.fixture
+def small_parts(monkeypatch):
+    # Offload everything, in parts small enough that the test data spans several
+    monkeypatch.setattr(lambda_function, 'OFFLOAD_THRESHOLD_BYTES', 1)
+    monkeypatch.setattr(lambda_function, 'MULTIPART_PART_BYTES', 16 * 1024)
+    monkeypatch.setattr(moto.s3.models, 'S3_UPLOAD_PART_MIN_SIZE', 1024)
+
+
+def exports(s3):
+    listing = s3.list_objects_v2(Bucket=BUCKET, Prefix=lambda_function.OFFLOAD_PREFIX)
+    return [item['Key'] for item in listing.get('Contents', [])]
+
+
+def test_large_result_is_streamed_to_s3_in_parts(inaturalist, s3, small_parts, monkeypatch):
+    monkeypatch.setattr(lambda_function, 'OFFLOAD_ENABLED', False)
+    inline = lambda_function.lambda_handler(data_event(**RANGE), None)
+    monkeypatch.setattr(lambda_function, 'OFFLOAD_ENABLED', True)
+    parts = []
+    lambda_function.get_s3_client().meta.events.register(
+        'before-parameter-build.s3.UploadPart', lambda params, **kwargs: parts.append(params['PartNumber']))
+
+    response = lambda_function.lambda_handler(data_event(**RANGE), None)
+
+    assert response['statusCode'] == 200
+    body = json.loads(response['body'])
+    assert body['row_count'] == len(inaturalist.observations)
+    assert body['metadata_version'] == lambda_function.DATA_METADATA_VERSION
+    assert body['expires_in'] == lambda_function.OFFLOAD_URL_EXPIRY
+    [key] = exports(s3)
+    assert key in body['download_url']
+    assert body['size_bytes'] == len(inline['body'].encode('utf-8'))
+    assert s3.get_object(Bucket=BUCKET, Key=key)['Body'].read() == inline['body'].encode('utf-8')
+    assert len(parts) > 1
+
+
+def test_offloaded_results_are_not_tagged(inaturalist, s3, small_parts):
+    first = lambda_function.lambda_handler(data_event(**RANGE), None)
+    repeat = data_event(**RANGE)
+    repeat['headers'] = {"If-None-Match": "*"}
+
+    second = lambda_function.lambda_handler(repeat, None)
+
+    assert 'ETag' not in first['headers']
+    assert second['statusCode'] == 200
+    assert json.loads(second['body'])['download_url'] != json.loads(first['body'])['download_url']
+    assert len(exports(s3)) == 2
+
+
+def test_failed_export_aborts_the_upload(s3, small_parts):
+    def chunks():
+        yield 'x' * (20 * 1024)
+        raise RuntimeError("serialization failed")
+
+    with pytest.raises(RuntimeError):
+        lambda_function.upload_chunks_multipart(chunks(), 'exports/broken.csv', content_type='text/csv')
+
+    assert s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+    assert exports(s3) == []
+
+
+def test_parquet_row_groups_are_uploaded_as_they_are_written(inaturalist, s3, small_parts, monkeypatch):
+    monkeypatch.setattr(lambda_function, 'PARQUET_ROW_GROUP_ROWS', 100)
+
+    response = lambda_function.lambda_handler(data_event(format='parquet', **RANGE), None)
+
+    body = json.loads(response['body'])
+    assert body['format'] == 'parquet'
+    [key] = exports(s3)
+    parquet_file = pq.ParquetFile(io.BytesIO(s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()))
+    assert parquet_file.metadata.num_rows == len(inaturalist.observations)
+    assert parquet_file.metadata.num_row_groups > 1
+
+
+def test_offload_estimate_follows_the_negotiated_encoding(inaturalist, s3, monkeypatch):
+    # 600 rows: about 108 kB of CSV, or about 50 kB once gzipped and base64-encoded
+    monkeypatch.setattr(lambda_function, 'OFFLOAD_THRESHOLD_BYTES', 80 * 1024)
+    compressed = data_event(**RANGE)
+    compressed['headers'] = {"Accept-Encoding": "gzip"}
+
+    plain = lambda_function.lambda_handler(data_event(**RANGE), None)
+    gzipped = lambda_function.lambda_handler(compressed, None)
+    parquet = lambda_function.lambda_handler(data_event(format="parquet", **RANGE), None)
+    ndjson = lambda_function.lambda_handler(data_event(format="ndjson", **RANGE), None)
+
+    assert 'download_url' in json.loads(plain['body'])
+    assert gzipped['headers']['Content-Encoding'] == 'gzip'
+    assert parquet['isBase64Encoded']
+    assert 'download_url' in json.loads(ndjson['body'])
+    assert len(exports(s3)) == 2
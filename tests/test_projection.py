@@ -0,0 +1,55 @@
+import json
+
+import lambda_function
+from conftest import observation
+
+
+def full_observation():
+    # Shaped like a raw iNaturalist result, with much more than the CSV needs
+    raw = observation(1, "2023-01-02", "Amanita muscaria", "fly agaric")
+    raw.update({
+        "description": "Under pines",
+        "geojson": {"type": "Point", "coordinates": [172.6, -43.5]},
+        "identifications": [{"id": 7, "taxon": {"name": "Amanita"}}],
+        "user": {"login": "ann", "name": "Ann", "icon": "https://static.inaturalist.org/icon.jpg"},
+        "photos": [
+            {"url": "https://static.inaturalist.org/photos/1/square.jpg", "attribution": "(c) Ann"},
+            {"url": "https://static.inaturalist.org/photos/2/square.jpg"},
+        ],
+    })
+    raw['taxon'].update({"id": 48715, "rank": "species", "ancestor_ids": [48460, 1, 47170]})
+    return raw
+
+
+def test_projection_keeps_only_the_fields_rows_read():
+    projected = lambda_function.project_observation(full_observation())
+
+    assert projected == {
+        "id": 1,
+        "observed_on": "2023-01-02",
+        "location": "-43.5,172.6",
+        "created_at": "2023-01-02T10:00:00+13:00",
+        "quality_grade": "research",
+        "user": {"login": "ann"},
+        "taxon": {"name": "Amanita muscaria", "preferred_common_name": "fly agaric", "native": True, "iconic_taxon_name": "Fungi"},
+        "photos": [{"url": "https://static.inaturalist.org/photos/1/square.jpg"}],
+    }
+    assert lambda_function.observation_row(projected) == lambda_function.observation_row(full_observation())
+
+
+def test_projection_tolerates_missing_fields():
+    sparse = {"id": 2, "user": {}, "taxon": {}, "photos": []}
+
+    projected = lambda_function.project_observation(sparse)
+
+    assert projected == {"id": 2, "user": {}, "taxon": {}}
+    assert lambda_function.observation_row(projected) == (2, "", "", "", "", "", "", "", "", "")
+
+
+def test_pages_are_decoded_and_projected():
+    content = json.dumps({"total_results": 31, "page": 1, "per_page": 2, "results": [full_observation(), full_observation()]})
+
+    page = lambda_function.decode_page(content.encode('utf-8'))
+
+    assert page == {"total_results": 31, "results": [lambda_function.project_observation(full_observation())] * 2}
+    assert lambda_function.decode_page(b'{}') == {"total_results": 0, "results": []}
@@ -0,0 +1,128 @@
+import gzip
+import json
+import shutil
+from datetime import date, datetime, timedelta
+
+import lambda_function
+from conftest import BUCKET, data_event
+
+HISTORY = {"start_date": "2023-01-01", "end_date": "2023-01-31"}
+
+
+def partition_keys(s3):
+    listing = s3.list_objects_v2(Bucket=BUCKET, Prefix=lambda_function.S3_CACHE_PREFIX)
+    return {item['Key'] for item in listing.get('Contents', [])}
+
+
+def record_puts(s3_client):
+    keys = []
+    s3_client.meta.events.register('before-parameter-build.s3.PutObject', lambda params, **kwargs: keys.append(params['Key']))
+    return keys
+
+
+def start_cold_container():
+    # A new container has an empty /tmp
+    shutil.rmtree(lambda_function.OBSERVATION_CACHE_DIR, ignore_errors=True)
+
+
+def test_settled_days_are_shared_as_gzipped_partitions(inaturalist, s3):
+    response = lambda_function.lambda_handler(data_event(**HISTORY), None)
+
+    assert response['statusCode'] == 200
+    assert partition_keys(s3) == {f"cache/observations/2023-01-{day:02d}.json.gz" for day in range(1, 32)}
+    stored = s3.get_object(Bucket=BUCKET, Key="cache/observations/2023-01-15.json.gz")['Body'].read()
+    partition = json.loads(gzip.decompress(stored))
+    expected = [obs['id'] for obs in inaturalist.observations if obs['observed_on'] == '2023-01-15']
+    assert sorted(obs['id'] for obs in partition['observations']) == sorted(expected)
+    assert partition['content_hash'] == lambda_function.observations_hash(partition['observations'])
+
+
+def test_cold_container_answers_history_from_s3(inaturalist, s3):
+    first = lambda_function.lambda_handler(data_event(**HISTORY), None)
+    start_cold_container()
+    upstream_calls = len(inaturalist.calls)
+
+    second = lambda_function.lambda_handler(data_event(**HISTORY), None)
+
+    assert len(inaturalist.calls) == upstream_calls
+    assert second['body'] == first['body']
+
+
+def test_history_is_written_once(inaturalist, s3, monkeypatch):
+    puts = record_puts(lambda_function.get_s3_client())
+    lambda_function.lambda_handler(data_event(**HISTORY), None)
+    assert len(puts) == 31
+
+    start_cold_container()
+    lambda_function.lambda_handler(data_event(**HISTORY), None)
+    monkeypatch.setattr(lambda_function, 'S3_CACHE_REVALIDATE_TTL', 0)
+    lambda_function.lambda_handler(data_event(**HISTORY), None)
+
+    assert len(puts) == 31
+
+
+def test_revalidation_is_etag_conditional(inaturalist, s3, monkeypatch):
+    first = lambda_function.lambda_handler(data_event(**HISTORY), None)
+    gets = []
+    lambda_function.get_s3_client().meta.events.register(
+        'before-parameter-build.s3.GetObject', lambda params, **kwargs: gets.append(params.get('IfNoneMatch')))
+    monkeypatch.setattr(lambda_function, 'S3_CACHE_REVALIDATE_TTL', 0)
+    upstream_calls = len(inaturalist.calls)
+
+    second = lambda_function.lambda_handler(data_event(**HISTORY), None)
+
+    assert len(gets) == 31 and all(gets)
+    assert len(inaturalist.calls) == upstream_calls
+    assert second['body'] == first['body']
+
+
+def test_read_s3_partition_statuses(s3):
+    day = date(2023, 1, 2)
+    assert lambda_function.read_s3_partition(day) == ('missing', None)
+
+    written = lambda_function.write_s3_partition(day, {"fetched_at": 1.0, "observations": [{"id": 1}]})
+
+    assert lambda_function.read_s3_partition(day, written['s3_etag']) == ('not_modified', None)
+    status, partition = lambda_function.read_s3_partition(day, '"stale"')
+    assert status == 'hit'
+    assert partition['observations'] == [{"id": 1}]
+    assert partition['s3_etag'] == written['s3_etag']
+
+
+def shared_ids(s3, day):
+    stored = s3.get_object(Bucket=BUCKET, Key=lambda_function.s3_partition_key(day))['Body'].read()
+    return [obs['id'] for obs in json.loads(gzip.decompress(stored))['observations']]
+
+
+def test_first_write_keeps_another_containers_copy(s3):
+    day = date(2023, 1, 2)
+    lambda_function.write_s3_partition(day, {"fetched_at": 1.0, "observations": [{"id": 1}]})
+
+    kept = lambda_function.write_s3_partition(day, {"fetched_at": 2.0, "observations": [{"id": 2}]})
+
+    assert kept['observations'] == [{"id": 1}]
+    assert shared_ids(s3, day) == [1]
+
+
+def test_sync_rewrite_needs_the_etag_it_was_synced_from(s3):
+    day = date(2023, 1, 2)
+    original = lambda_function.write_s3_partition(day, {"fetched_at": 1.0, "observations": [{"id": 1}]})
+    synced = lambda_function.write_s3_partition(day, {**original, "fetched_at": 2.0, "observations": [{"id": 1}, {"id": 2}]})
+    assert shared_ids(s3, day) == [1, 2]
+
+    # A container still holding the original copy must not overwrite the newer sync
+    stale = lambda_function.write_s3_partition(day, {**original, "fetched_at": 3.0, "observations": [{"id": 3}]})
+
+    assert shared_ids(s3, day) == [1, 2]
+    assert stale['observations'] == [{"id": 1}, {"id": 2}]
+    assert stale['s3_etag'] == synced['s3_etag'] != original['s3_etag']
+
+
+def test_recent_days_stay_out_of_s3(inaturalist, s3):
+    today = datetime.now().date()
+    recent = {"start_date": (today - timedelta(days=3)).isoformat(), "end_date": today.isoformat()}
+
+    response = lambda_function.lambda_handler(data_event(**recent), None)
+
+    assert response['statusCode'] == 200
+    assert partition_keys(s3) == set()
@@ -0,0 +1,97 @@
+import gzip
+import time
+import base64
+import threading
+import http.client
+
+import pytest
+
+import server
+
+
+class RunningServer:
+    # PooledHTTPServer on an ephemeral port, with lambda_handler answered by `respond` and every event kept
+    def __init__(self):
+        self.invocations = []
+        self.respond = lambda event: {"statusCode": 200, "headers": {"Content-Type": "text/csv"}, "body": "id\n1\n"}
+        self.server = server.PooledHTTPServer(('127.0.0.1', 0), server.LambdaRequestHandler, 2)
+
+    def lambda_handler(self, event, context):
+        self.invocations.append((event, context.get_remaining_time_in_millis()))
+        return self.respond(event)
+
+    def connect(self):
+        return http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=10)
+
+
+@pytest.fixture
+def running(monkeypatch):
+    running = RunningServer()
+    monkeypatch.setattr(server.lambda_function, 'lambda_handler', running.lambda_handler)
+    threading.Thread(target=running.server.serve_forever, daemon=True).start()
+    yield running
+    running.server.shutdown()
+    running.server.server_close()
+
+
+def test_requests_are_translated_into_proxy_events(running):
+    connection = running.connect()
+
+    connection.request('GET', '/data?api_key=test-key&start_date=2023-01-01&taxon=Amanita%20muscaria',
+                       headers={"Accept-Encoding": "gzip", "If-None-Match": '"abc"'})
+    response = connection.getresponse()
+
+    assert (response.status, response.read(), response.getheader('Content-Type')) == (200, b"id\n1\n", "text/csv")
+    [(event, remaining_ms)] = running.invocations
+    assert event['requestContext']['path'] == '/data'
+    assert event['queryStringParameters'] == {"api_key": "test-key", "start_date": "2023-01-01", "taxon": "Amanita muscaria"}
+    assert event['headers']['Accept-Encoding'] == 'gzip'
+    assert event['headers']['If-None-Match'] == '"abc"'
+    assert 0 < remaining_ms <= server.SERVER_REQUEST_TIMEOUT * 1000
+
+
+def test_connections_are_kept_alive_and_bodies_decoded(running):
+    body = gzip.compress(b"id\n1\n")
+    running.respond = lambda event: {
+        "statusCode": 200,
+        "headers": {"Content-Encoding": "gzip"},
+        "body": base64.b64encode(body).decode('ascii'),
+        "isBase64Encoded": True,
+    }
+    connection = running.connect()
+
+    for _ in range(2):
+        connection.request('GET', '/summary')
+        response = connection.getresponse()
+        assert response.read() == body
+    running.respond = lambda event: {"statusCode": 304, "headers": {"ETag": '"abc"'}, "body": ""}
+    connection.request('GET', '/summary')
+    response = connection.getresponse()
+
+    assert (response.status, response.read(), response.getheader('Content-Length')) == (304, b"", "0")
+    assert len(running.invocations) == 3
+
+
+def test_shutdown_waits_for_requests_in_progress_within_the_grace_period(running, monkeypatch):
+    monkeypatch.setattr(server, 'SERVER_SHUTDOWN_GRACE', 1)
+    started, release = threading.Event(), threading.Event()
+
+    def slow(event):
+        started.set()
+        release.wait(10)
+        return {"statusCode": 200, "body": "done"}
+
+    idle = running.connect()
+    idle.request('GET', '/data')
+    idle.getresponse().read()  # Kept alive, so a worker waits on it
+    running.respond = slow
+    threading.Thread(target=lambda: running.connect().request('GET', '/data'), daemon=True).start()
+    assert started.wait(5)
+
+    running.server.shutdown()
+    closing = time.monotonic()
+    running.server.server_close()
+    elapsed = time.monotonic() - closing
+    release.set()
+
+    assert 1 <= elapsed < 2
@@ -0,0 +1,55 @@
+import json
+
+import lambda_function
+from conftest import observation
+
+RANGE = {"start_date": "2023-01-01", "end_date": "2023-01-31"}
+
+# 2023-01-02 and 2023-01-09 are Mondays; 2023-01-15 is the Sunday ending the second week
+OBSERVATIONS = [
+    observation(1, "2023-01-02", "Amanita muscaria", "fly agaric"),
+    observation(2, "2023-01-03", "Amanita muscaria", "fly agaric"),
+    observation(3, "2023-01-09", "Boletus edulis", "penny bun"),
+    observation(4, "2023-01-15", "Amanita muscaria", "fly agaric"),
+    observation(5, "2023-01-15", "Clathrus ruber", "red cage"),
+    observation(6, "2023-01-15", "Boletus edulis", "penny bun"),
+]
+
+
+def summary_event(**query):
+    return {
+        "requestContext": {"path": "/summary"},
+        "queryStringParameters": {"api_key": "test-key", **query},
+    }
+
+
+def test_summary_counts(inaturalist):
+    inaturalist.observations = OBSERVATIONS
+
+    response = lambda_function.lambda_handler(summary_event(**RANGE), None)
+
+    assert response['statusCode'] == 200
+    summary = json.loads(response['body'])
+    assert summary['total_observations'] == 6
+    assert summary['species_count'] == 3
+    assert (summary['first_sighting'], summary['last_sighting']) == ("2023-01-02", "2023-01-15")
+    assert summary['species'] == [
+        {"name": "Amanita muscaria", "common_name": "Fly Agaric", "count": 3, "first_seen": "2023-01-02", "last_seen": "2023-01-15"},
+        {"name": "Boletus edulis", "common_name": "Penny Bun", "count": 2, "first_seen": "2023-01-09", "last_seen": "2023-01-15"},
+        {"name": "Clathrus ruber", "common_name": "Red Cage", "count": 1, "first_seen": "2023-01-15", "last_seen": "2023-01-15"},
+    ]
+    assert summary['per_day'] == {"2023-01-02": 1, "2023-01-03": 1, "2023-01-09": 1, "2023-01-15": 3}
+    assert summary['per_week'] == {"2023-01-02": 2, "2023-01-09": 4}
+
+
+def test_summary_is_reused_while_the_partitions_are_unchanged(inaturalist, monkeypatch):
+    inaturalist.observations = OBSERVATIONS
+    first = lambda_function.lambda_handler(summary_event(**RANGE), None)
+    monkeypatch.setattr(lambda_function, 'SUMMARY_CACHE_TTL', 0)
+    repeat = summary_event(**RANGE)
+    repeat['headers'] = {"If-None-Match": first['headers']['ETag']}
+
+    second = lambda_function.lambda_handler(repeat, None)
+
+    assert second['statusCode'] == 304
+    assert second['headers']['ETag'] == first['headers']['ETag']
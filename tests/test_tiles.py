@@ -0,0 +1,71 @@
+import json
+
+import lambda_function
+from conftest import observation
+
+RANGE = {"start_date": "2023-01-01", "end_date": "2023-01-31"}
+CHRISTCHURCH = "-43.5,172.6"  # Web Mercator x 0.979, y 0.634: cell (15, 10) at zoom 0, (31, 20) at zoom 1
+
+OBSERVATIONS = [
+    observation(1, "2023-01-02", "Amanita muscaria", location=CHRISTCHURCH),
+    observation(2, "2023-01-03", "Amanita muscaria", location=CHRISTCHURCH),
+    observation(3, "2023-01-04", "Hygrocybe rubrocarnosa", location=CHRISTCHURCH),
+    observation(4, "2023-01-05", "Clathrus ruber", location=CHRISTCHURCH),
+    observation(5, "2023-01-06", "Boletus edulis", location=CHRISTCHURCH),
+    observation(6, "2023-01-07", "Clathrus ruber", location="0,0"),  # Cell (8, 8) at zoom 0, (16, 16) at zoom 1
+    observation(7, "2023-01-08", "Boletus edulis", location=""),  # Not mapped
+]
+
+
+def tile_event(z, x, y, **headers):
+    return {
+        "requestContext": {"path": f"/tiles/{z}/{x}/{y}"},
+        "queryStringParameters": {"api_key": "test-key", **RANGE},
+        "headers": headers,
+    }
+
+
+def tile(z, x, y):
+    response = lambda_function.lambda_handler(tile_event(z, x, y), None)
+    assert response['statusCode'] == 200
+    return json.loads(response['body'])
+
+
+def test_observations_are_binned_into_cells(inaturalist):
+    inaturalist.observations = OBSERVATIONS
+
+    world = tile(0, 0, 0)
+    south_east = tile(1, 1, 1)
+    north_west = tile(1, 0, 0)
+
+    assert world['total'] == 6
+    assert world['cells'] == [
+        {"row": 8, "col": 8, "count": 1, "top_taxa": [{"name": "Clathrus ruber", "count": 1}]},
+        {"row": 10, "col": 15, "count": 5, "top_taxa": [
+            {"name": "Amanita muscaria", "count": 2},
+            {"name": "Boletus edulis", "count": 1},
+            {"name": "Clathrus ruber", "count": 1},
+        ]},
+    ]
+    assert [(cell['row'], cell['col'], cell['count']) for cell in south_east['cells']] == [(0, 0, 1), (4, 15, 5)]
+    assert north_west == {**north_west, "total": 0, "cells": []}
+
+
+def test_rendered_tiles_are_evicted_least_recently_used_first(inaturalist, monkeypatch):
+    inaturalist.observations = OBSERVATIONS
+    monkeypatch.setattr(lambda_function, 'TILE_BODY_ENTRIES', 2)
+
+    for x, y in [(0, 0), (1, 1), (0, 0), (1, 0)]:
+        tile(1, x, y)
+
+    [cached] = lambda_function._tile_cache.values()
+    assert list(cached['bodies']) == [(1, 0, 0), (1, 1, 0)]
+
+
+def test_tiles_are_not_resent_while_unchanged(inaturalist):
+    inaturalist.observations = OBSERVATIONS
+    first = lambda_function.lambda_handler(tile_event(0, 0, 0), None)
+
+    second = lambda_function.lambda_handler(tile_event(0, 0, 0, **{"If-None-Match": first['headers']['ETag']}), None)
+
+    assert second['statusCode'] == 304
@@ -0,0 +1,110 @@
+import time
+import threading
+
+import pytest
+
+import lambda_function
+from conftest import data_event
+from lambda_function import UpstreamGovernor
+
+
+def governor(rate_per_minute=0, burst=1, max_concurrency=8, latency_target=5, recovery_successes=3):
+    return UpstreamGovernor(rate_per_minute, burst, max_concurrency, latency_target, recovery_successes)
+
+
+def request(upstream, status, latency=0.1, retry_after=0):
+    upstream.acquire()
+    upstream.release(status, latency, retry_after)
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_throttling_halves_the_concurrency_limit(status):
+    upstream = governor()
+
+    request(upstream, status)
+    request(upstream, status)
+
+    assert upstream.limit == 2
+
+
+@pytest.mark.parametrize("status, latency", [(200, 10), (None, 10), (500, 0.1), (502, 0.1), (504, 0.1)])
+def test_slow_failed_or_timed_out_requests_ease_off(status, latency):
+    upstream = governor()
+
+    request(upstream, status, latency)
+
+    assert upstream.limit == 6
+    assert upstream.paused_until == 0
+
+
+def test_fast_successes_recover_one_slot_at_a_time():
+    upstream = governor(max_concurrency=4)
+    request(upstream, 429)
+    request(upstream, 429)
+
+    for expected in [1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4, 4]:
+        request(upstream, 200)
+        assert upstream.limit == expected
+
+
+def test_retry_after_pauses_every_thread(monkeypatch):
+    upstream = governor()
+    request(upstream, 429, retry_after=0.3)
+
+    started = time.monotonic()
+    upstream.acquire()
+
+    assert time.monotonic() - started >= 0.25
+    monkeypatch.setattr(lambda_function, 'UPSTREAM_MAX_PAUSE', 0.2)
+    upstream.release(429, 0.1, retry_after=3600)
+    assert upstream.paused_until - time.monotonic() <= 0.2
+
+
+def test_the_concurrency_limit_holds_requests_back():
+    upstream = governor(max_concurrency=1)
+    upstream.acquire()
+    second = threading.Thread(target=upstream.acquire)
+    second.start()
+
+    second.join(0.2)
+    assert second.is_alive()
+    upstream.release(200, 0.1)
+    second.join(1)
+    assert not second.is_alive()
+
+
+def test_the_token_bucket_spaces_requests_out():
+    upstream = governor(rate_per_minute=600)
+    request(upstream, 200)
+
+    started = time.monotonic()
+    request(upstream, 200)
+
+    assert time.monotonic() - started >= 0.08
+
+
+def test_server_errors_are_retried_through_the_governor(inaturalist, monkeypatch):
+    monkeypatch.setattr(lambda_function, 'HTTP_BACKOFF_FACTOR', 0)
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_CACHE_ENABLED', False)
+    upstream = governor(rate_per_minute=60, burst=10)
+    monkeypatch.setattr(lambda_function, '_upstream_governor', upstream)
+    statuses = iter([502, 500])
+    inaturalist.fail = lambda query: next(statuses, None)
+
+    response = lambda_function.lambda_handler(data_event(start_date="2023-01-01", end_date="2023-01-02"), None)
+
+    assert response['statusCode'] == 200
+    assert len(inaturalist.calls) == 3
+    assert upstream.tokens < 7.5  # One token per attempt
+    assert upstream.limit < upstream.max_concurrency
+
+
+def test_server_errors_reach_the_client_once_retries_run_out(inaturalist, monkeypatch):
+    monkeypatch.setattr(lambda_function, 'HTTP_BACKOFF_FACTOR', 0)
+    monkeypatch.setattr(lambda_function, 'OBSERVATION_CACHE_ENABLED', False)
+    inaturalist.fail = lambda query: 504
+
+    response = lambda_function.lambda_handler(data_event(start_date="2023-01-01", end_date="2023-01-02"), None)
+
+    assert response['statusCode'] == 504
+    assert len(inaturalist.calls) == lambda_function.HTTP_MAX_RETRIES + 1